@@ -0,0 +1,235 @@
+import argparse
+import json
+import os
+import platform
+import random
+import sys
+import time
+import tracemalloc
+from datetime import datetime, timedelta
+
+import numpy as np
+import openpyxl
+import pandas as pd
+from openpyxl.worksheet.cell_range import CellRange
+
+from processing import (
+    build_cube,
+    build_date_index,
+    clean_data,
+    create_date_tree,
+    cube_cells,
+    filter_rows,
+    load_excel_separately,
+    shift_summary,
+    stream_excel,
+)
+
+MAIN_COLUMNS = [
+    "Дата", "Время", "№ смены",
+    "Разгружено машин", "Загружено машин", "Разгружено тракторов", "Загружено тракторов",
+    "Принято паллет", "Отгружено паллет", "Паллет без системы",
+    "Грузооборот всего",
+]
+
+EMPLOYEE_COLUMNS = [
+    "Старший смены", "Помощник старшего смены", "Кладовщик",
+    "Водитель погрузчика", "Рабочий склада", "Всего сотрудников",
+]
+
+# Варианты записи, которые встречаются в реальных книгах
+DAY_TIMES = ["6:00-18:00", "6-18", "6.00 – 18.00", " 6:00 - 18:00", "6.00-18.00"]
+NIGHT_TIMES = ["18:00-6:00", "18-6", "18.00—6.00", "18:00 - 6:00", "18.00-6.00"]
+SHIFT_VALUES = ["А", "A", "Б", "B", "В", "C", "Г", "D", "1", "2", 3, 4, "а", " Б "]
+
+# Не больше десяти лет истории: для больших книг растет число строк в дне
+MAX_DAYS = 3650
+
+def generate_workbook(path, rows, seed=0):
+    """Пишет книгу с листом "Грузооборот" из rows строк данных.
+
+    Структура как у рабочих файлов: строка-заголовок отчета, две строки
+    заголовков (столбцы сотрудников - подстолбцы второй строки), дата
+    объединена на все строки дня, буквы смен в разных алфавитах, время
+    в разных форматах, редкие нераспознаваемые смены и формулы.
+    """
+    rng = random.Random(seed)
+    rows_per_day = max(2, -(-rows // MAX_DAYS))
+    rows_per_day += rows_per_day % 2
+
+    wb = openpyxl.Workbook(write_only=True)
+    ws = wb.create_sheet("Грузооборот")
+    ws.append(["Отчет по грузообороту склада"])
+    ws.append(MAIN_COLUMNS + ["Сотрудники"] + [None] * (len(EMPLOYEE_COLUMNS) - 1))
+    ws.append([None] * len(MAIN_COLUMNS) + EMPLOYEE_COLUMNS)
+
+    # Заголовки основных столбцов объединены по вертикали на две строки
+    for col in range(1, len(MAIN_COLUMNS) + 1):
+        ws.merged_cells.add(CellRange(min_col=col, min_row=2, max_col=col, max_row=3))
+    ws.merged_cells.add(CellRange(min_col=len(MAIN_COLUMNS) + 1, min_row=2,
+                                  max_col=len(MAIN_COLUMNS) + len(EMPLOYEE_COLUMNS), max_row=2))
+
+    first_day = datetime(2015, 1, 1)
+    written = 0
+    excel_row = 4
+    day = 0
+    while written < rows:
+        day_rows = min(rows_per_day, rows - written)
+        for i in range(day_rows):
+            night = i % 2 == 1
+            shift = rng.choice(SHIFT_VALUES) if rng.random() > 0.002 else rng.choice(["x", None, ""])
+            time_str = rng.choice(NIGHT_TIMES if night else DAY_TIMES)
+            vehicles = [rng.randint(0, 40) for _ in range(4)]
+            pallets = [rng.randint(0, 600) for _ in range(3)]
+            turnover = sum(pallets) * rng.randint(1, 3)
+            if rng.random() < 0.001:
+                turnover = "=SUM(H{0}:J{0})".format(excel_row)
+            staff = [1, rng.randint(0, 1), rng.randint(1, 4), rng.randint(1, 8), rng.randint(3, 25)]
+
+            ws.append(
+                [first_day + timedelta(days=day) if i == 0 else None, time_str, shift]
+                + vehicles + pallets + [turnover] + staff + [sum(staff)]
+            )
+            excel_row += 1
+
+        if day_rows > 1:
+            ws.merged_cells.add(CellRange(min_col=1, min_row=excel_row - day_rows,
+                                          max_col=1, max_row=excel_row - 1))
+        written += day_rows
+        day += 1
+
+    wb.save(path)
+
+def run_stages(path):
+    """Прогоняет конвейер дашборда по книге и возвращает время этапов (сек).
+
+    Этапы называются по функциям конвейера: их внутренние замеры (timings) сюда
+    не попадают, чтобы ключи для сравнения с --baseline не зависели от подписей.
+    """
+    stages = {}
+
+    started = time.perf_counter()
+    df = load_excel_separately(path)
+    stages["load_excel_separately"] = time.perf_counter() - started
+
+    started = time.perf_counter()
+    df = clean_data(df)
+    stages["clean_data"] = time.perf_counter() - started
+
+    started = time.perf_counter()
+    stream_excel(path)
+    stages["stream_excel"] = time.perf_counter() - started
+
+    started = time.perf_counter()
+    date_index = build_date_index(df)
+    stages["build_date_index"] = time.perf_counter() - started
+
+    started = time.perf_counter()
+    create_date_tree(date_index)
+    stages["create_date_tree"] = time.perf_counter() - started
+
+    # Фильтр как в сайдбаре: последние 30 дней, все смены
+    selected_days = np.zeros(len(date_index["dates"]), dtype=bool)
+    selected_days[-30:] = True
+    shifts = list(df["Время"].cat.categories)
+    numbers = list(df["№ смены"].cat.categories)
+
+    started = time.perf_counter()
+    filter_rows(df, date_index, selected_days, shifts, numbers)
+    stages["filter_rows"] = time.perf_counter() - started
+
+    started = time.perf_counter()
+    cube = build_cube(df, date_index)
+    stages["build_cube"] = time.perf_counter() - started
+
+    columns = [c for c in MAIN_COLUMNS[3:] + EMPLOYEE_COLUMNS if c in cube["sum"].columns]
+    started = time.perf_counter()
+    shift_summary(cube, cube_cells(cube, np.ones_like(selected_days), shifts, numbers), columns)
+    stages["shift_summary"] = time.perf_counter() - started
+
+    return stages, len(df)
+
+def peak_memory_mb(path):
+    """Пик аллокаций за один прогон конвейера по книге, МБ.
+
+    Считает tracemalloc (numpy и pandas сообщают ему о своих буферах), поэтому
+    цифра относится только к этому прогону, без генерации книги и прошлых
+    размеров, и одинакова по смыслу на всех ОС. Прогон отдельный от замеров
+    времени: трассировка замедляет аллокации.
+    """
+    tracemalloc.start()
+    try:
+        run_stages(path)
+        return tracemalloc.get_traced_memory()[1] / 1024 ** 2
+    finally:
+        tracemalloc.stop()
+
+def compare(results, baseline, tolerance):
+    """Этапы, которые стали медленнее базового прогона больше чем на tolerance"""
+    previous = {entry["rows"]: entry["stages"] for entry in baseline["results"]}
+    regressions = []
+    for entry in results:
+        for stage, seconds in entry["stages"].items():
+            before = previous.get(entry["rows"], {}).get(stage)
+            # Совсем короткие этапы не сравниваем: там один шум таймера
+            if before and before > 0.01 and seconds > before * (1 + tolerance):
+                regressions.append((entry["rows"], stage, before, seconds))
+    return regressions
+
+def main():
+    parser = argparse.ArgumentParser(description="Замеры этапов обработки книги Грузооборот")
+    parser.add_argument("--sizes", type=int, nargs="+", default=[1_000, 10_000, 100_000, 1_000_000],
+                        help="число строк данных в сгенерированных книгах")
+    parser.add_argument("--data-dir", default="bench_data", help="куда складывать сгенерированные книги")
+    parser.add_argument("--output", default="bench_results.json", help="файл с результатами (JSON)")
+    parser.add_argument("--repeat", type=int, default=3, help="число прогонов; берется минимум по этапу")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--baseline", help="JSON прошлого прогона для поиска регрессий")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="допустимое замедление этапа, доля")
+    args = parser.parse_args()
+
+    os.makedirs(args.data_dir, exist_ok=True)
+    results = []
+    for rows in args.sizes:
+        path = os.path.join(args.data_dir, f"gruzooborot_{rows}_{args.seed}.xlsx")
+        if not os.path.exists(path):
+            print(f"Генерация {path}...", file=sys.stderr)
+            started = time.perf_counter()
+            generate_workbook(path, rows, seed=args.seed)
+            print(f"  {time.perf_counter() - started:.1f} с", file=sys.stderr)
+
+        best = {}
+        for _ in range(args.repeat):
+            stages, clean_rows = run_stages(path)
+            for stage, seconds in stages.items():
+                best[stage] = min(seconds, best.get(stage, seconds))
+
+        results.append({
+            "rows": rows,
+            "clean_rows": clean_rows,
+            "file_bytes": os.path.getsize(path),
+            "peak_mb": peak_memory_mb(path),
+            "stages": best,
+        })
+        print(f"{rows:>9} строк: " + ", ".join(f"{k} {v:.3f}" for k, v in best.items()), file=sys.stderr)
+
+    report = {
+        "created": datetime.now().isoformat(timespec="seconds"),
+        "python": platform.python_version(),
+        "pandas": pd.__version__,
+        "repeat": args.repeat,
+        "results": results,
+    }
+    with open(args.output, "w", encoding="utf-8") as f:
+        json.dump(report, f, ensure_ascii=False, indent=2)
+
+    if args.baseline:
+        with open(args.baseline, encoding="utf-8") as f:
+            regressions = compare(results, json.load(f), args.tolerance)
+        for rows, stage, before, after in regressions:
+            print(f"Регрессия: {rows} строк, {stage}: {before:.3f} -> {after:.3f} с", file=sys.stderr)
+        if regressions:
+            sys.exit(1)
+
+if __name__ == "__main__":
+    main()
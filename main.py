@@ -1,8 +1,50 @@
+import numpy as np
 import pandas as pd
 import streamlit as st
 import plotly.express as px
-import re
-from datetime import datetime
+import hashlib
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+
+from processing import (
+    DuckDBStore,
+    FolderWatcher,
+    LRUCache,
+    ParseJob,
+    build_cube,
+    build_date_index,
+    build_trends,
+    category_mask,
+    create_date_tree,
+    cube_cells,
+    dataset_profile,
+    date_time_label,
+    days_between,
+    downsample_long,
+    duckdb_path,
+    dynamics_frame,
+    filter_positions,
+    history_contains,
+    history_dir,
+    history_version,
+    load_history,
+    load_snapshot,
+    precomputed_workbooks,
+    merge_into_history,
+    percent_changes,
+    save_snapshot,
+    select_days,
+    StageProfiler,
+    diagnostics_enabled,
+    shift_summary,
+    snapshot_dir,
+    take_rows,
+    trend_frame,
+    watch_dir,
+    watch_interval,
+)
 
 st.set_page_config(
     page_title="Дашборд по складу",
@@ -59,240 +101,763 @@ st.markdown("""
 st.sidebar.title("📊 Навигация")
 page = st.sidebar.radio(
     "Раздел:",
-    ["Главная", "Динамика", "Процентные изменения", "Анализ по сменам"]
+    ["Главная", "Динамика", "Процентные изменения", "Анализ по сменам", "Тренды"]
 )
 
 uploaded_file = st.sidebar.file_uploader("📤 Загрузите Excel-файл", type=["xlsx"])
 
+# Файл убрали из загрузчика - его разбор больше не нужен
+if not uploaded_file and "parse_job" in st.session_state:
+    st.session_state.pop("parse_job").cancel()
+
+# Замеры этапов прогона доступны, только если их включили через DASHBOARD_DIAGNOSTICS:
+# tracemalloc общий для процесса и после запуска замедляет аллокации всех сессий
+diagnostics = diagnostics_enabled() and st.sidebar.checkbox("🩺 Диагностика прогона", value=True)
+profiler = StageProfiler(diagnostics)
+
 # ==================== ФУНКЦИИ ======================
-def normalize_time_str(time_str):
-    """Приводит формат времени к виду 6:00-18:00 / 18:00-6:00"""
-    if pd.isna(time_str):
-        return None
-    
-    s = str(time_str).strip()
+def show_diagnostics(**context):
+    """Панель и журнал диагностики прогона: в конце страницы и перед каждой остановкой.
+
+    context - поля записи журнала (файл, страница, число строк, причина остановки).
+    """
+    if not profiler.enabled:
+        return
+    stages = profiler.finish()
+    with st.expander(f"🩺 Диагностика прогона: {profiler.total_seconds:.2f} с"):
+        st.dataframe(pd.DataFrame(stages).style.format(precision=3), use_container_width=True, hide_index=True)
+        st.caption("Пик памяти - прирост аллокаций Python (tracemalloc) от начала этапа.")
     
-    # Если уже в правильном формате, возвращаем как есть
-    if s in ["6:00-18:00", "18:00-6:00"]:
-        return s
+    log_path = os.environ.get("DASHBOARD_DIAGNOSTICS_LOG")
+    if log_path:
+        try:
+            profiler.write_log(log_path, page=page, **context)
+        except OSError as e:
+            st.sidebar.warning(f"Не удалось записать журнал диагностики: {e}")
+
+def stop_run(reason, **context):
+    """Останавливает прогон, как st.stop(), но сначала выводит и пишет его диагностику"""
+    show_diagnostics(stopped=reason, **context)
+    st.stop()
+
+def show_parse_error(error):
+    """Показывает ошибку фонового разбора по ее виду"""
+    if error["kind"] == "cancelled":
+        st.info(f"⏹ {error['message']}. Загрузите другой файл или разберите этот заново.")
+        if st.button("🔄 Разобрать заново", key="restart_parse"):
+            st.session_state.pop("parse_job", None)
+            st.rerun()
+        return
+    st.error(error["message"])
+    if error["kind"] == "header":
+        st.write("Первые 5 строк файла:")
+        st.dataframe(error["preview"])
+    elif error["kind"] == "columns":
+        st.info("Найденные столбцы:")
+        st.write(error["found"])
+
+@st.fragment(run_every=0.5)
+def parse_progress(job):
+    """Прогресс фонового разбора; по его окончании перезапускает страницу"""
+    if job.done:
+        st.rerun()
+    text = f"⏳ {job.stage}"
+    if job.rows:
+        rows = f"{job.rows:,}".replace(",", " ")
+        text += f": {rows} строк" if job.fraction is None else f": {rows} из {job.total_rows:,} строк".replace(",", " ")
+    st.progress(job.fraction or 0.0, text=f"{text}, {time.perf_counter() - job.started:.0f} с")
+    if st.button("✖ Отменить разбор", key="cancel_parse"):
+        job.cancel()
+        st.rerun()
+
+def parse_upload(uploaded_file, file_hash, timings):
+    """Очищенные данные загруженной книги: из снимка прошлых сессий или фоновым разбором.
+
+    Разбор идет в общем пуле потоков; пока он не закончен, страница показывает
+    прогресс и дальше не строится. Новый файл отменяет разбор предыдущего.
+    """
+    snapshots = snapshot_dir()
+    if snapshots:
+        started = time.perf_counter()
+        df = load_snapshot(file_hash, snapshots)
+        if df is not None:
+            timings["Чтение снимка"] = time.perf_counter() - started
+            return df
     
-    # Заменяем различные типы дефисов и убираем пробелы
-    s = s.replace("–", "-").replace("—", "-").replace(" ", "")
-    s = s.replace(".", ":")
+    job = st.session_state.get("parse_job")
+    if job is None or job.key != file_hash:
+        if job is not None:
+            job.cancel()
+        job = ParseJob(file_hash, uploaded_file.getvalue(), get_parse_executor())
+        st.session_state["parse_job"] = job
     
-    # Извлекаем числа из строки
-    numbers = re.findall(r'\d+', s)
+    if not job.done:
+        st.markdown(f"### 📥 Разбор файла {uploaded_file.name}")
+        parse_progress(job)
+        stop_run("разбор идет", file=file_hash)
+    if job.error:
+        show_parse_error(job.error)
+        stop_run(f"ошибка разбора: {job.error['kind']}", file=file_hash)
     
-    if len(numbers) >= 2:
-        first_num = int(numbers[0])
-        second_num = int(numbers[1])
-        
-        # Определяем формат на основе первого числа
-        if first_num == 6:
-            return "6:00-18:00"
-        elif first_num == 18:
-            return "18:00-6:00"
-    
-    # Если не удалось определить, возвращаем исходное значение
-    return s
-
-def process_merged_cells(df):
-    """Обрабатывает объединенные ячейки в столбце Дата"""
-    df_processed = df.copy()
-    
-    # Заполняем пропущенные даты предыдущими значениями
-    df_processed["Дата"] = df_processed["Дата"].ffill()
-    
-    return df_processed
-
-def process_shift_numbers(df):
-    """Обрабатывает номера смен: преобразует буквы в цифры и удаляет строки с None"""
-    df_processed = df.copy()
-    
-    # Создаем словарь для преобразования букв в цифры
-    shift_mapping = {
-        'А': '1', 'A': '1',  # Кириллическая и латинская A
-        'Б': '2', 'B': '2',  # Кириллическая Б и латинская B
-        'В': '3', 'C': '3',  # Кириллическая В и латинская C
-        'Г': '4', 'D': '4',  # Кириллическая Г и латинская D
-    }
+    # Результат забирается один раз: дальше данные живут в кэше загрузок
+    df = job.result()
+    timings.update(job.timings)
+    timings["Фоновый разбор"] = time.perf_counter() - job.started
+    del st.session_state["parse_job"]
     
-    # Функция для преобразования одного значения
-    def convert_shift(value):
-        if pd.isna(value) or value is None or value == '':
-            return None
-        
-        value_str = str(value).strip().upper()
-        
-        # Если значение уже цифра от 1 до 4, оставляем как есть
-        if value_str in ['1', '2', '3', '4']:
-            return value_str
-        
-        # Если значение буква, преобразуем по словарю
-        if value_str in shift_mapping:
-            return shift_mapping[value_str]
-        
-        # Если значение не распознано, возвращаем None
-        return None
+    if snapshots:
+        started = time.perf_counter()
+        try:
+            save_snapshot(df, file_hash, snapshots)
+            timings["Запись снимка"] = time.perf_counter() - started
+        except Exception as e:  # снимок только ускоряет загрузку, его сбой не критичен
+            st.sidebar.warning(f"Не удалось сохранить снимок данных: {e}")
+    return df
+
+def paged_table(df, key, rows=None, page_sizes=(25, 50, 100, 500)):
+    """Постраничная таблица: сортировка и выбор столбцов на сервере, в браузер уходит одна страница.
+
+    rows - номера строк df для показа (по умолчанию все); копируется только страница.
+    """
+    if rows is None:
+        rows = np.arange(len(df))
+    controls = st.columns([4, 2, 1, 1, 1])
+    columns = controls[0].multiselect("Столбцы:", list(df.columns), default=list(df.columns), key=f"{key}_columns")
+    sort_column = controls[1].selectbox("Сортировка:", ["Без сортировки"] + columns, key=f"{key}_sort")
+    descending = controls[2].checkbox("По убыванию", key=f"{key}_descending")
+    page_size = controls[3].selectbox("Строк:", page_sizes, key=f"{key}_page_size")
     
-    # Применяем преобразование к столбцу "№ смены"
-    df_processed["№ смены"] = df_processed["№ смены"].apply(convert_shift)
+    # Номер страницы может выйти за границы после смены фильтров или размера страницы
+    total = len(rows)
+    pages = max(1, -(-total // page_size))
+    page_key = f"{key}_page"
+    if st.session_state.get(page_key, 1) > pages:
+        st.session_state[page_key] = pages
+    page = controls[4].number_input("Страница:", min_value=1, max_value=pages, step=1, key=page_key)
     
-    # Удаляем строки, где номер смены None (после преобразования)
-    df_processed = df_processed.dropna(subset=["№ смены"])
+    start = (page - 1) * page_size
+    end = min(start + page_size, total)
+    if sort_column in df.columns:
+        order = (take_rows(df, rows, [sort_column])[sort_column].reset_index(drop=True)
+                 .sort_values(ascending=not descending, kind="stable", na_position="last")
+                 .index)
+        page_rows = rows[order[start:end]]
+    else:
+        page_rows = rows[start:end]
     
-    return df_processed
+    st.dataframe(take_rows(df, page_rows, columns), use_container_width=True)
+    st.caption(f"Строки {start + 1 if total else 0}–{end} из {total}, страница {page} из {pages}")
+
+@st.cache_resource
+def get_upload_cache():
+    """Общий для всех сессий кэш загрузок; лимиты задаются переменными окружения"""
+    max_entries = int(os.environ.get("DASHBOARD_CACHE_MAX_ENTRIES", 8))
+    max_mb = os.environ.get("DASHBOARD_CACHE_MAX_MB")
+    max_bytes = int(float(max_mb) * 1024 * 1024) if max_mb else None
+    return LRUCache(max_entries=max_entries, max_bytes=max_bytes)
+
+@st.cache_resource
+def get_result_cache():
+    """Общий для всех сессий кэш производных таблиц; ключи включают хэш файла и фильтры"""
+    max_entries = int(os.environ.get("DASHBOARD_RESULT_CACHE_MAX_ENTRIES", 64))
+    max_mb = float(os.environ.get("DASHBOARD_RESULT_CACHE_MAX_MB", 128))
+    return LRUCache(max_entries=max_entries, max_bytes=int(max_mb * 1024 * 1024))
+
+@st.cache_resource
+def get_parse_executor():
+    """Общий пул потоков для разбора загрузок (DASHBOARD_PARSE_WORKERS)"""
+    return ThreadPoolExecutor(max_workers=int(os.environ.get("DASHBOARD_PARSE_WORKERS", 2)),
+                              thread_name_prefix="upload-parser")
+
+@st.cache_resource
+def get_figure_cache():
+    """Общий для всех сессий кэш фигур Plotly; объем оценивается по данным трасс"""
+    max_entries = int(os.environ.get("DASHBOARD_FIGURE_CACHE_MAX_ENTRIES", 64))
+    max_mb = float(os.environ.get("DASHBOARD_FIGURE_CACHE_MAX_MB", 64))
+    return LRUCache(max_entries=max_entries, max_bytes=int(max_mb * 1024 * 1024))
+
+def figure_nbytes(fig):
+    """Оценка объема фигуры по числу значений в трассах, без сериализации в JSON"""
+    total = 0
+    for trace in fig.data:
+        # Оформление трассы и раскладки - небольшая постоянная добавка
+        total += 1024
+        for attr in ("x", "y", "z", "customdata", "text", "hovertext"):
+            values = getattr(trace, attr, None)
+            if values is not None and not isinstance(values, str):
+                total += np.size(values) * 8
+    return total
+
+def cached_figure(key, build):
+    """Фигура из кэша фигур; build() строит ее заново только при промахе.
+
+    Ключ должен включать filter_key и выбранные показатели, чтобы перезапуски от
+    посторонних виджетов не пересобирали графики.
+    """
+    figure_cache = get_figure_cache()
+    fig = figure_cache.get(key)
+    if fig is None:
+        fig = build()
+        figure_cache.put(key, fig, figure_nbytes(fig))
+    return fig
+
+@st.cache_resource
+def get_duckdb_store():
+    """Общее для процесса хранилище DuckDB или None, если SQL-бэкенд выключен"""
+    path = duckdb_path()
+    return DuckDBStore(path) if path else None
+
+@st.cache_resource
+def get_folder_watcher():
+    """Общий для процесса фоновый разбор папки или None, если режим выключен"""
+    directory = watch_dir()
+    return FolderWatcher(directory, watch_interval()).start() if directory else None
+
+@st.fragment(run_every=watch_interval())
+def watch_status(watcher, seen_version):
+    """Состояние разбора файлов папки; когда готовы новые данные, перезапускает страницу"""
+    if watcher.version != seen_version:
+        st.rerun()
+    for name, (state, message) in sorted(watcher.status().items()):
+        if message:
+            st.warning(f"📂 {name}: {state} - {message}")
+        else:
+            st.caption(f"⏳ {name}: {state}")
+
+# ==================== СТРАНИЦЫ ======================
+# Разделы страниц и полоса KPI - фрагменты: действия с их виджетами
+# перезапускают только сам фрагмент, без загрузки, сайдбара и блока информации.
+# Все входные данные передаются явно аргументами.
+@st.fragment
+def kpi_strip(cube, cube_selection):
+    """Сводные KPI за выбранный период по ячейкам куба"""
+    st.subheader("🔹 Сводные KPI за выбранный период")
+
+    def safe_sum(col):
+        return cube["sum"].loc[cube_selection, col].sum() if col in cube["sum"].columns else 0
+
+    def safe_mean(col):
+        if col not in cube["count"].columns:
+            return 0
+        count = cube["count"].loc[cube_selection, col].sum()
+        return safe_sum(col) / count if count else float("nan")
+
+    total_turnover = safe_sum("Грузооборот всего")
+    avg_turnover = safe_mean("Грузооборот всего")
+    total_unloaded = safe_sum("Разгружено машин")
+    total_loaded = safe_sum("Загружено машин")
+
+    col1, col2, col3, col4 = st.columns(4)
+    col1.markdown(f"<div class='kpi-card'><div class='kpi-value'>{total_turnover:,.0f}</div><div class='kpi-label'>Грузооборот всего</div></div>", unsafe_allow_html=True)
+    col2.markdown(f"<div class='kpi-card'><div class='kpi-value'>{avg_turnover:,.0f}</div><div class='kpi-label'>Средний грузооборот</div></div>", unsafe_allow_html=True)
+    col3.markdown(f"<div class='kpi-card'><div class='kpi-value'>{total_unloaded:,.0f}</div><div class='kpi-label'>Разгружено машин</div></div>", unsafe_allow_html=True)
+    col4.markdown(f"<div class='kpi-card'><div class='kpi-value'>{total_loaded:,.0f}</div><div class='kpi-label'>Загружено машин</div></div>", unsafe_allow_html=True)
 
-def create_date_tree(df):
-    """Создает дерево дат для фильтрации: Год -> Месяц -> Неделя -> День"""
-    unique_dates = df["Дата"].unique()
+@st.fragment
+def main_page(source_df, row_positions):
+    """Главная: таблица выбранных строк"""
+    st.markdown("### 📋 Таблица по выбранным данным")
+    paged_table(source_df, "main_table", rows=row_positions)
+
+@st.fragment
+def dynamics_page(source_df, row_positions, cube, cube_selection, date_index, numeric_cols, filter_key):
+    """Динамика: график выбранных показателей по сменам, дням, неделям или месяцам"""
+    st.markdown("### 📈 Динамика показателей")
+    selected_metric = st.multiselect("Выберите показатели:", numeric_cols, default=["Грузооборот всего"])
+    buckets = {"По сменам": "shift", "По дням": "day", "По неделям ISO": "week", "По месяцам": "month"}
+    bucket_name = st.radio("Группировка:", list(buckets), horizontal=True)
     
-    date_tree = {}
+    # Бюджет точек на один показатель: дальше - линия WebGL с прореживанием
+    max_bars = 200
+    max_points = 1000
     
-    for date in unique_dates:
-        year = date.year
-        month = date.month
-        week = datetime(year, month, date.day).isocalendar()[1]
-        day = date.day
+    def build_dynamics():
+        bucket = buckets[bucket_name]
+        title = "Изменения показателей по датам и времени"
+        # Строки нужны только для графика по сменам, остальное берется из куба
+        shift_rows = take_rows(source_df, row_positions, ["Дата", "Время"] + selected_metric) if bucket == "shift" else None
+        long_df = dynamics_frame(shift_rows, cube, cube_selection, date_index, selected_metric, bucket)
+        points = long_df.groupby("Показатель").size().max()
         
-        if year not in date_tree:
-            date_tree[year] = {}
+        if points <= max_bars:
+            if bucket == "shift":
+                # Подпись "дата время" как раньше, чтобы смены не сливались на оси
+                long_df["Дата_Время"] = np.tile(date_time_label(shift_rows).values, len(selected_metric))
+            
+            # Столбчатая диаграмма
+            fig = px.bar(long_df, x="Дата_Время", y="Значение", color="Показатель",
+                         title=title,
+                         barmode='group')  # 'group' для группировки столбцов
+        else:
+            long_df = downsample_long(long_df, max_points)
+            # Подпись о прореживании хранится в заголовке, чтобы фигура кэшировалась целиком
+            shown = long_df.groupby("Показатель").size().max()
+            fig = px.line(long_df, x="Дата_Время", y="Значение", color="Показатель",
+                          title=f"{title}<br><sup>Показано {shown} из {points} точек на показатель</sup>",
+                          render_mode="webgl")
         
-        if month not in date_tree[year]:
-            date_tree[year][month] = {}
+        # Настройка внешнего вида
+        fig.update_layout(
+            xaxis_title="Дата и время",
+            yaxis_title="Значение",
+            legend_title="Показатели",
+            xaxis_tickangle=-45
+        )
+        return fig
+    
+    if selected_metric:
+        fig = cached_figure(("dynamics", filter_key, tuple(selected_metric), buckets[bucket_name]), build_dynamics)
+        st.plotly_chart(fig, use_container_width=True)
+
+@st.fragment
+def changes_page(source_df, row_positions, cube, cube_selection, date_index, numeric_cols, filter_key):
+    """Процентные изменения выбранных показателей"""
+    st.markdown("### 📊 Процентные изменения показателей")
+    change_metrics = st.multiselect("Выберите показатели:", numeric_cols, default=["Грузооборот всего"], key="change_metrics")
+    change_modes = {
+        "Подряд по строкам": "rows",
+        "Внутри времени смены": "Время",
+        "Внутри номера смены": "№ смены",
+        "По дням": "day",
+        "По неделям ISO": "week",
+    }
+    change_mode = st.radio("Сравнивать:", list(change_modes), horizontal=True, key="change_mode")
+    
+    if change_metrics:
+        # Результат зависит только от данных, фильтров, показателей и режима
+        change_cache = get_result_cache()
+        change_key = ("changes", filter_key, tuple(change_metrics), change_modes[change_mode])
+        df_change = change_cache.get(change_key)
+        if df_change is None:
+            change_rows = take_rows(source_df, row_positions, ["Дата", "Время", "№ смены"] + change_metrics)
+            df_change = percent_changes(change_rows, cube, cube_selection, date_index,
+                                        change_metrics, change_modes[change_mode])
+            change_cache.put(change_key, df_change, int(df_change.memory_usage(deep=True).sum()))
+        paged_table(df_change, "change_table")
+
+@st.fragment
+def shifts_page(source_df, cube, cube_selection, filter_key):
+    """Анализ по сменам: сводка и графики из куба агрегатов"""
+    st.markdown("## 🔄 Анализ по сменам")
+    
+    # Явно указываем столбцы которые у нас есть
+    vehicle_columns = [
+        'Разгружено машин', 
+        'Загружено машин', 
+        'Разгружено тракторов', 
+        'Загружено тракторов'
+    ]
+    
+    pallet_columns = [
+        'Принято паллет', 
+        'Отгружено паллет', 
+        'Паллет без системы'
+    ]
+    
+    employee_columns = [
+        'Старший смены',
+        'Помощник старшего смены', 
+        'Кладовщик',
+        'Водитель погрузчика',
+        'Рабочий склада',
+        'Всего сотрудников'
+    ]
+    
+    # Проверяем какие столбцы действительно есть в данных
+    existing_vehicle_cols = [col for col in vehicle_columns if col in source_df.columns]
+    existing_pallet_cols = [col for col in pallet_columns if col in source_df.columns]
+    existing_employee_cols = [col for col in employee_columns if col in source_df.columns]
+    
+    st.write(f"**Найдены столбцы транспорта:** {existing_vehicle_cols}")
+    st.write(f"**Найдены столбцы паллет:** {existing_pallet_cols}")
+    st.write(f"**Найдены столбцы сотрудников:** {existing_employee_cols}")
+    
+    # Проверяем наличие столбца с общим количеством сотрудников
+    if 'Всего сотрудников' not in source_df.columns:
+        st.error("❌ Столбец 'Всего сотрудников' не найден в данных!")
+        st.info("Доступные столбцы:")
+        st.write(list(source_df.columns))
+        return
+    
+    # Группируем по сменам (из куба агрегатов)
+    shift_columns = existing_vehicle_cols + existing_pallet_cols + existing_employee_cols + ['Грузооборот всего']
+    result_cache = get_result_cache()
+    summary_key = ("shift_summary", filter_key, tuple(shift_columns))
+    shift_analysis = result_cache.get(summary_key)
+    if shift_analysis is None:
+        shift_analysis = shift_summary(cube, cube_selection, shift_columns)
+        result_cache.put(summary_key, shift_analysis, int(shift_analysis.memory_usage(deep=True).sum()))
+    
+    # Создаем две колонки для отображения
+    col1, col2 = st.columns(2)
+    
+    with col1:
+        st.markdown("### 🚛 Транспортные средства по сменам")
         
-        if week not in date_tree[year][month]:
-            date_tree[year][month][week] = []
+        if existing_vehicle_cols:
+            def build_vehicles():
+                # Создаем график для транспортных средств
+                vehicle_melted = pd.melt(shift_analysis, 
+                                        id_vars=['№ смены'], 
+                                        value_vars=existing_vehicle_cols,
+                                        var_name='Тип транспорта', 
+                                        value_name='Количество')
+                
+                fig_vehicles = px.bar(vehicle_melted, 
+                                     x='№ смены', 
+                                     y='Количество', 
+                                     color='Тип транспорта',
+                                     title='Обработанные транспортные средства по сменам',
+                                     barmode='group')
+                
+                fig_vehicles.update_layout(
+                    xaxis_title="Номер смены",
+                    yaxis_title="Количество",
+                    legend_title="Тип транспорта"
+                )
+                return fig_vehicles
+            
+            fig_vehicles = cached_figure(("shift_vehicles", filter_key, tuple(existing_vehicle_cols)), build_vehicles)
+            st.plotly_chart(fig_vehicles, use_container_width=True)
+            
+            # Таблица с детализацией
+            st.markdown("#### Детализация по транспортным средствам")
+            vehicle_table = shift_analysis[['№ смены'] + existing_vehicle_cols]
+            st.dataframe(vehicle_table, use_container_width=True)
+        else:
+            st.error("Не найдено столбцов с данными о транспортных средствах")
+    
+    with col2:
+        st.markdown("### 📦 Паллеты по сменам")
         
-        if day not in date_tree[year][month][week]:
-            date_tree[year][month][week].append(day)
-    
-    # Сортируем дни в каждой неделе
-    for year in date_tree:
-        for month in date_tree[year]:
-            for week in date_tree[year][month]:
-                date_tree[year][month][week].sort()
-    
-    return date_tree
-
-def load_excel_separately(uploaded_file):
-    """Загружает основные столбцы и подстолбцы отдельно, затем объединяет"""
-    try:
-        # Загружаем данные с двумя строками заголовков чтобы увидеть структуру
-        df_raw = pd.read_excel(uploaded_file, sheet_name="Грузооборот", header=None, nrows=5)
+        if existing_pallet_cols:
+            def build_pallets():
+                # Создаем график для паллет
+                pallet_melted = pd.melt(shift_analysis, 
+                                       id_vars=['№ смены'], 
+                                       value_vars=existing_pallet_cols,
+                                       var_name='Тип операции', 
+                                       value_name='Количество')
+                
+                fig_pallets = px.bar(pallet_melted, 
+                                    x='№ смены', 
+                                    y='Количество', 
+                                    color='Тип операции',
+                                    title='Принятые и отгруженные паллеты по сменам',
+                                    barmode='group')
+                
+                fig_pallets.update_layout(
+                    xaxis_title="Номер смены",
+                    yaxis_title="Количество",
+                    legend_title="Тип операции"
+                )
+                return fig_pallets
+            
+            fig_pallets = cached_figure(("shift_pallets", filter_key, tuple(existing_pallet_cols)), build_pallets)
+            st.plotly_chart(fig_pallets, use_container_width=True)
+            
+            # Таблица с детализацией
+            st.markdown("#### Детализация по паллетам")
+            pallet_table = shift_analysis[['№ смены'] + existing_pallet_cols]
+            st.dataframe(pallet_table, use_container_width=True)
+        else:
+            st.error("Не найдено столбцов с данными о паллетах")
+    
+    # Детализация по сотрудникам
+    if len(existing_employee_cols) > 1:  # Если есть больше чем just 'Всего сотрудников'
+        st.markdown("### 👥 Детализация по сотрудникам по сменам")
         
-        # Ищем строку с основными заголовками (Дата, Время, № смены)
-        header_row = None
-        for i in range(min(5, len(df_raw))):
-            row_values = df_raw.iloc[i].dropna().astype(str).str.strip().tolist()
-            if 'Дата' in row_values and 'Время' in row_values and '№ смены' in row_values:
-                header_row = i
-                break
+        def build_employees():
+            # Создаем график для сотрудников
+            employee_melted = pd.melt(shift_analysis, 
+                                     id_vars=['№ смены'], 
+                                     value_vars=[col for col in existing_employee_cols if col != 'Всего сотрудников'],
+                                     var_name='Должность', 
+                                     value_name='Количество')
+            
+            fig_employees = px.bar(employee_melted, 
+                                  x='№ смены', 
+                                  y='Количество', 
+                                  color='Должность',
+                                  title='Распределение сотрудников по должностям и сменам',
+                                  barmode='stack')
+            
+            fig_employees.update_layout(
+                xaxis_title="Номер смены",
+                yaxis_title="Количество сотрудников",
+                legend_title="Должность"
+            )
+            return fig_employees
         
-        if header_row is None:
-            st.error("Не удалось найти строку с заголовками (Дата, Время, № смены)")
-            st.write("Первые 5 строк файла:")
-            st.dataframe(df_raw)
-            st.stop()
+        fig_employees = cached_figure(("shift_employees", filter_key, tuple(existing_employee_cols)), build_employees)
+        st.plotly_chart(fig_employees, use_container_width=True)
         
-        # Загружаем основные данные начиная с найденной строки заголовков
-        df_main = pd.read_excel(uploaded_file, sheet_name="Грузооборот", header=header_row)
+        # Таблица с детализацией по сотрудникам
+        st.markdown("#### Детализация по сотрудникам")
+        employee_table = shift_analysis[['№ смены'] + existing_employee_cols]
+        st.dataframe(employee_table, use_container_width=True)
+    
+    # Сводная статистика по сменам
+    st.markdown("### 📊 Сводная статистика по сменам")
+    
+    # Создаем карточки с KPI для каждой смены из уже посчитанной сводки
+    for shift_row in shift_analysis.to_dict("records"):
+        st.markdown(f"#### Смена {shift_row['№ смены']}")
         
-        # Убираем пустые строки и Unnamed колонки
-        df_main.dropna(how="all", inplace=True)
-        df_main = df_main.loc[:, ~df_main.columns.str.contains("Unnamed", na=False)]
+        # Создаем колонки для метрик
+        cols = st.columns(5)
         
-        # Теперь загружаем подстолбцы сотрудников
-        # Предполагаем, что подстолбцы находятся в следующей строке после заголовков
-        employee_header_row = header_row + 1
+        # Общее количество записей по смене
+        with cols[0]:
+            st.metric("Всего записей", int(shift_row['Всего записей']))
         
-        # Загружаем данные еще раз, начиная со строки подстолбцов
-        df_employees_raw = pd.read_excel(uploaded_file, sheet_name="Грузооборот", header=employee_header_row)
+        # Транспортные средства
+        with cols[1]:
+            if existing_vehicle_cols:
+                total_vehicles = sum(shift_row[col] for col in existing_vehicle_cols)
+                st.metric("Всего транспорта", f"{total_vehicles:,.0f}")
+            else:
+                st.metric("Всего транспорта", "Нет данных")
         
-        # Выбираем только столбцы сотрудников
-        employee_columns = [
-            'Старший смены', 'Помощник старшего смены', 'Кладовщик', 
-            'Водитель погрузчика', 'Рабочий склада', 'Всего сотрудников'
-        ]
+        # Паллеты
+        with cols[2]:
+            if existing_pallet_cols:
+                total_pallets = sum(shift_row[col] for col in existing_pallet_cols)
+                st.metric("Всего паллет", f"{total_pallets:,.0f}")
+            else:
+                st.metric("Всего паллет", "Нет данных")
         
-        # Ищем эти столбцы в данных
-        employee_data = {}
-        for col in employee_columns:
-            if col in df_employees_raw.columns:
-                employee_data[col] = df_employees_raw[col]
+        # Грузооборот
+        with cols[3]:
+            st.metric("Грузооборот", f"{shift_row['Грузооборот всего']:,.0f}")
         
-        # Если нашли столбцы сотрудников, добавляем их к основным данным
-        if employee_data:
-            employee_df = pd.DataFrame(employee_data)
-            
-            # Убеждаемся, что количество строк совпадает
-            min_rows = min(len(df_main), len(employee_df))
-            df_main = df_main.iloc[:min_rows].copy()
-            employee_df = employee_df.iloc[:min_rows].copy()
-            
-            # Объединяем данные
-            for col in employee_columns:
-                if col in employee_df.columns:
-                    df_main[col] = employee_df[col].values
+        # Состав смены - ТОЧНОЕ количество сотрудников из столбца 'Всего сотрудников'
+        # (сумма за все дни выбранного периода)
+        with cols[4]:
+            st.metric("Всего сотрудников", f"{shift_row['Всего сотрудников']:,.0f}")
+    
+    # Дополнительная аналитика
+    st.markdown("### 📈 Сравнительный анализ смен")
+    
+    col1, col2 = st.columns(2)
+    
+    with col1:
+        # Эффективность по грузообороту на человека (посчитана в shift_summary)
+        fig_efficiency = cached_figure(("shift_efficiency", filter_key), lambda: px.bar(
+            shift_analysis,
+            x='№ смены',
+            y='Эффективность',
+            title='Эффективность по грузообороту на сотрудника по сменам',
+            color='Эффективность'))
         
-        return df_main
+        st.plotly_chart(fig_efficiency, use_container_width=True)
+    
+    with col2:
+        # Общий грузооборот по сменам
+        fig_turnover = cached_figure(("shift_turnover", filter_key), lambda: px.pie(
+            shift_analysis,
+            values='Грузооборот всего',
+            names='№ смены',
+            title='Распределение грузооборота по сменам'))
         
-    except Exception as e:
-        st.error(f"Ошибка при загрузке файла: {e}")
-        st.stop()
-
-# ==================== ОСНОВНАЯ ЛОГИКА ======================
-if uploaded_file:
-    # Загружаем и обрабатываем файл
-    df = load_excel_separately(uploaded_file)
+        st.plotly_chart(fig_turnover, use_container_width=True)
     
-    # Проверяем наличие основных столбцов
-    required_columns = ["Дата", "Время", "№ смены"]
-    missing_columns = [col for col in required_columns if col not in df.columns]
+    # Детальная таблица всех показателей по сменам
+    st.markdown("### 📋 Полная сводка по сменам")
     
-    if missing_columns:
-        st.error(f"Не найдены необходимые столбцы: {missing_columns}")
-        st.info("Найденные столбцы:")
-        st.write(list(df.columns))
-        st.stop()
+    # Переименовываем столбцы для лучшего отображения
+    display_columns = {
+        '№ смены': 'Смена',
+        'Грузооборот всего': 'Грузооборот',
+        'Всего сотрудников': 'Всего сотрудников',
+        'Эффективность': 'Эффективность (грузооборот/сотрудник)'
+    }
+    
+    shift_display = shift_analysis.rename(columns=display_columns)
+    st.dataframe(shift_display, use_container_width=True)
 
-    # Обрабатываем объединенные ячейки в столбце Дата
-    df = process_merged_cells(df)
+@st.fragment
+def trends_page(cube, date_index, selected_days, selected_shift_numbers, filter_key):
+    """Тренды: скользящие средние и изменения к прошлой неделе и месяцу по номерам смен"""
+    st.markdown("### 📉 Тренды по сменам")
+    
+    trend_columns = [
+        'Грузооборот всего',
+        'Принято паллет',
+        'Отгружено паллет',
+        'Паллет без системы',
+        'Разгружено машин',
+        'Загружено машин',
+        'Разгружено тракторов',
+        'Загружено тракторов'
+    ]
+    trend_columns = [col for col in trend_columns if col in cube["sum"].columns]
+    if not trend_columns:
+        st.error("Не найдено столбцов грузооборота, паллет или транспорта")
+        return
+    
+    metric = st.selectbox("Показатель:", trend_columns, key="trend_metric")
+    windows = st.multiselect("Скользящее среднее, дней:", [7, 14, 28], default=[7, 28], key="trend_windows")
+    st.caption("Значения - суммы за сутки по номеру смены; фильтр по времени смены здесь не применяется. "
+               "Окна берут и дни до начала выбранного периода.")
+    
+    # Префиксные суммы строятся один раз на набор данных, дальше любое окно - O(1) на точку
+    result_cache = get_result_cache()
+    trends_key = ("trends", filter_key[0])
+    trends = result_cache.get(trends_key)
+    if trends is None:
+        trends = build_trends(cube, date_index, trend_columns)
+        result_cache.put(trends_key, trends, trends["sum"].nbytes + trends["present"].nbytes)
+    
+    chosen = np.flatnonzero(selected_days)
+    numbers = np.flatnonzero(category_mask(cube["number_categories"], selected_shift_numbers)[:-1])
+    table = trend_frame(trends, metric, numbers, trends["offsets"][chosen[0]], trends["offsets"][chosen[-1]])
+    
+    def build_trends_figure():
+        long_df = pd.melt(table, id_vars=["Дата", "№ смены"],
+                          value_vars=["За день"] + [f"Среднее {window} дн." for window in windows],
+                          var_name="Ряд", value_name="Значение")
+        fig = px.line(long_df, x="Дата", y="Значение", color="№ смены", line_dash="Ряд",
+                      title=f"{metric}: за день и скользящие средние")
+        fig.update_layout(xaxis_title="Дата", yaxis_title=metric, legend_title="Смена, ряд")
+        return fig
+    
+    fig = cached_figure(("trends", filter_key, metric, tuple(windows)), build_trends_figure)
+    st.plotly_chart(fig, use_container_width=True)
     
-    # Обрабатываем номера смен
-    df = process_shift_numbers(df)
+    # Последний выбранный день: текущие средние и изменения по каждой смене
+    st.markdown("#### Последний день периода")
+    latest = table[table["Дата"] == table["Дата"].max()]
+    st.dataframe(latest.style.format(precision=1), use_container_width=True, hide_index=True)
+    
+    st.markdown("#### По дням")
+    paged_table(table, "trend_table")
 
-    # Преобразуем дату
-    df["Дата"] = pd.to_datetime(df["Дата"], errors="coerce").dt.date
-    df = df.dropna(subset=["Дата"])
+# ==================== ОСНОВНАЯ ЛОГИКА ======================
+# С историей дашборд строится по всем влитым загрузкам, даже без нового файла
+history = history_dir()
+watcher = get_folder_watcher()
+watched = None
 
-    # Преобразуем время
-    df["Время"] = df["Время"].apply(normalize_time_str)
+if watcher is not None:
+    # Загрузка только кладется в папку: разбирает ее фоновый обработчик, а не сессия
+    if uploaded_file:
+        watcher.add_file(uploaded_file.name, uploaded_file.getvalue())
+    seen_version = watcher.version
+    ready = watcher.datasets()
+    names = sorted(ready, key=lambda name: ready[name]["parsed_at"], reverse=True)
+    with st.sidebar:
+        if names:
+            default = names.index(uploaded_file.name) if uploaded_file and uploaded_file.name in names else 0
+            watched_name = st.selectbox("📂 Данные из папки:", names, index=default, key="watched_dataset")
+            watched = ready[watched_name]
+        watch_status(watcher, seen_version)
 
-    # Преобразуем числовые столбцы
-    for col in df.columns:
-        if col not in ["Дата", "Время", "№ смены"]:
-            # Обрабатываем формулы (начинаются с =)
-            if df[col].astype(str).str.startswith('=').any():
-                # Для формул просто преобразуем в числа, Excel уже вычислил значения
-                df[col] = pd.to_numeric(df[col], errors='coerce')
-            else:
-                df[col] = pd.to_numeric(df[col], errors="coerce")
+duckdb_store = get_duckdb_store()
+stored = duckdb_store is not None and duckdb_store.version() is not None
 
-    # Комбинированная колонка
-    df["Дата_Время"] = df["Дата"].astype(str) + " " + df["Время"].astype(str)
+# Книги из ночного предрасчета (precompute.py в каталог снимков) открываются без загрузки файла
+precomputed_hash = None
+if watcher is None and duckdb_store is None and not history and not uploaded_file and snapshot_dir():
+    precomputed = precomputed_workbooks(snapshot_dir())
+    if precomputed:
+        precomputed_name = st.sidebar.selectbox("🗄️ Предрасчитанные книги:", sorted(precomputed),
+                                                key="precomputed_workbook")
+        precomputed_hash = precomputed[precomputed_name]
+
+if watched is not None or precomputed_hash or (
+        watcher is None and (uploaded_file or stored or (history and history_version(history)))):
+    profiler.mark("Загрузка и кэш")
+    
+    # Очищенные данные берем из кэша по хэшу содержимого файла
+    upload_cache = get_upload_cache()
+    load_timings = {}
+    
+    if watched is not None:
+        # Набор из папки уже разобран: ключ меняется вместе с подписью файла
+        file_hash = "watch_" + hashlib.sha1(f"{watched_name}|{watched['signature']}".encode()).hexdigest()
+    elif duckdb_store is not None:
+        # С SQL-бэкендом загрузки вливаются в одну таблицу DuckDB по ключу строки
+        if not stored and history and history_version(history):
+            # История, накопленная до включения DuckDB, переносится в пустую таблицу один раз
+            duckdb_store.upsert(load_history(history, load_timings), f"history_{history_version(history)}")
+        if uploaded_file:
+            upload_hash = hashlib.sha256(uploaded_file.getvalue()).hexdigest()
+            if not duckdb_store.contains(upload_hash):
+                upload_df = parse_upload(uploaded_file, upload_hash, load_timings)
+                if history and not history_contains(history, upload_hash):
+                    merge_into_history(upload_df, upload_hash, history, load_timings)
+                started = time.perf_counter()
+                duckdb_store.upsert(upload_df, upload_hash)
+                load_timings["Запись в DuckDB"] = time.perf_counter() - started
+        version = duckdb_store.version()
+        if version is None:
+            st.info("📁 В загруженном файле нет строк с датой и сменой.")
+            stop_run("нет строк")
+        file_hash = f"duckdb_{version}"
+    elif history:
+        # Новая загрузка вливается в историю по месяцам; уже влитая повторно не разбирается
+        if uploaded_file:
+            upload_hash = hashlib.sha256(uploaded_file.getvalue()).hexdigest()
+            if not history_contains(history, upload_hash):
+                upload_df = parse_upload(uploaded_file, upload_hash, load_timings)
+                merge_into_history(upload_df, upload_hash, history, load_timings)
+        version = history_version(history)
+        if version is None:
+            st.info("📁 В загруженном файле нет строк с датой и сменой для истории.")
+            stop_run("нет строк")
+        file_hash = f"history_{version}"
+    elif precomputed_hash:
+        file_hash = precomputed_hash
+    else:
+        file_hash = hashlib.sha256(uploaded_file.getvalue()).hexdigest()
+    cached = watched if watched is not None else upload_cache.get(file_hash)
+    
+    if cached is None:
+        if file_hash.startswith("duckdb_"):
+            # Строки остаются в DuckDB: в сессии только индекс дат, куб и сводка
+            started = time.perf_counter()
+            date_index = duckdb_store.date_index()
+            cube = duckdb_store.build_cube(date_index)
+            profile = duckdb_store.profile(date_index, cube)
+            df = None
+            load_timings["Куб агрегатов (DuckDB)"] = time.perf_counter() - started
+            cached_bytes = sum(int(cube[part].memory_usage(deep=True).sum()) for part in ["sum", "count", "sumsq"])
+        else:
+            if history:
+                df = load_history(history, load_timings)
+            elif precomputed_hash:
+                started = time.perf_counter()
+                df = load_snapshot(precomputed_hash, snapshot_dir())
+                load_timings["Чтение снимка"] = time.perf_counter() - started
+            else:
+                df = parse_upload(uploaded_file, file_hash, load_timings)
+            date_index = build_date_index(df)
+            started = time.perf_counter()
+            cube = build_cube(df, date_index)
+            load_timings["Куб агрегатов"] = time.perf_counter() - started
+            profile = dataset_profile(df)
+            cached_bytes = int(df.memory_usage(deep=True).sum())
+        
+        cached = {"df": df, "date_index": date_index, "cube": cube, "profile": profile, "timings": load_timings}
+        upload_cache.put(file_hash, cached, cached_bytes)
+    
+    df = cached["df"]
+    date_index = cached["date_index"]
+    cube = cached["cube"]
+    profile = cached["profile"]
+    load_timings = cached["timings"]
 
-    numeric_cols = [c for c in df.select_dtypes(include=["int64", "float64"]).columns if c not in ["№ смены"]]
+    # Числовые столбцы те же, что в кубе: все числовые, кроме номера смены
+    numeric_cols = list(cube["sum"].columns)
 
     # ======== ФИЛЬТРЫ В САЙДБАРЕ ========
+    profiler.mark("Фильтры в сайдбаре")
     st.sidebar.markdown("---")
     st.sidebar.markdown("### 🔧 Фильтры")
     
-    # Создаем дерево дат
-    date_tree = create_date_tree(df)
-    
     # Фильтр по времени смены
-    shift_options = sorted(df["Время"].dropna().unique().tolist())
+    shift_options = list(cube["time_categories"])
     selected_shifts = st.sidebar.multiselect(
         "Выберите время смены:", 
         shift_options, 
@@ -300,14 +865,15 @@ if uploaded_file:
     )
     
     # Фильтр по номеру смены
-    shift_number_options = sorted(df["№ смены"].dropna().unique().tolist())
+    shift_number_options = list(cube["number_categories"])
     selected_shift_numbers = st.sidebar.multiselect(
         "Выберите номер смены:",
         shift_number_options,
         default=shift_number_options
     )
     
-    # Дерево выбора дат
+    # Выбор дат: пресеты, диапазон или дни месяца. Виджетов всегда несколько,
+    # сколько бы дней ни было в файле
     st.sidebar.markdown("### 📅 Выбор дат")
     
     months_dict = {
@@ -316,69 +882,106 @@ if uploaded_file:
         9: "Сентябрь", 10: "Октябрь", 11: "Ноябрь", 12: "Декабрь"
     }
     
-    selected_dates = set()
+    # Выбранные дни - битовая маска по уникальным дням индекса
+    selected_days = np.zeros(len(date_index["dates"]), dtype=bool)
     
-    for year in sorted(date_tree.keys()):
-        with st.sidebar.expander(str(year)):
-            year_key = f"select_all_year_{year}"
-            select_all_year = st.checkbox("Выбрать все в году", value=False, key=year_key)
-            
-            if select_all_year:
-                for month in date_tree[year]:
-                    for week in date_tree[year][month]:
-                        for day in date_tree[year][month][week]:
-                            selected_dates.add(datetime(year, month, day).date())
-            else:
-                for month in sorted(date_tree[year].keys()):
-                    month_name = months_dict[month]
-                    with st.expander(month_name):
-                        month_key = f"select_all_month_{year}_{month}"
-                        select_all_month = st.checkbox("Выбрать все в месяце", value=False, key=month_key)
-                        
-                        if select_all_month:
-                            for week in date_tree[year][month]:
-                                for day in date_tree[year][month][week]:
-                                    selected_dates.add(datetime(year, month, day).date())
-                        else:
-                            for week in sorted(date_tree[year][month].keys()):
-                                with st.expander(f"Неделя {week}"):
-                                    week_key = f"select_all_week_{year}_{month}_{week}"
-                                    select_all_week = st.checkbox("Выбрать все в неделе", value=False, key=week_key)
-                                    
-                                    if select_all_week:
-                                        for day in date_tree[year][month][week]:
-                                            selected_dates.add(datetime(year, month, day).date())
-                                    else:
-                                        for day in sorted(date_tree[year][month][week]):
-                                            day_key = f"day_{year}_{month}_{week}_{day}"
-                                            select_day = st.checkbox(str(day), value=False, key=day_key)
-                                            if select_day:
-                                                selected_dates.add(datetime(year, month, day).date())
+    if len(date_index["dates"]):
+        first_date = date_index["dates"][0].date()
+        last_date = date_index["dates"][-1].date()
+        
+        date_mode = st.sidebar.selectbox(
+            "Период:",
+            ["Последние 7 дней", "Последние 30 дней", "Месяц", "Неделя ISO", "Диапазон", "По дням"],
+            index=1,
+            key="date_mode"
+        )
+        
+        if date_mode == "Последние 7 дней":
+            selected_days = days_between(date_index, last_date - timedelta(days=6), last_date)
+        
+        elif date_mode == "Последние 30 дней":
+            selected_days = days_between(date_index, last_date - timedelta(days=29), last_date)
+        
+        elif date_mode == "Месяц":
+            month_keys = pd.unique(date_index["year"] * 100 + date_index["month"])[::-1]
+            month_key = st.sidebar.selectbox(
+                "Месяц:",
+                month_keys.tolist(),
+                format_func=lambda key: f"{months_dict[key % 100]} {key // 100}",
+                key="date_month"
+            )
+            selected_days = select_days(date_index, month_key // 100, month_key % 100)
+        
+        elif date_mode == "Неделя ISO":
+            week_keys = pd.unique(date_index["iso_year"] * 100 + date_index["week"])[::-1]
+            week_key = st.sidebar.selectbox(
+                "Неделя:",
+                week_keys.tolist(),
+                format_func=lambda key: f"Неделя {key % 100}, {key // 100}",
+                key="date_week"
+            )
+            selected_days = ((date_index["iso_year"] == week_key // 100)
+                             & (date_index["week"] == week_key % 100))
+        
+        elif date_mode == "Диапазон":
+            period = st.sidebar.date_input(
+                "Даты:",
+                value=(max(first_date, last_date - timedelta(days=29)), last_date),
+                min_value=first_date,
+                max_value=last_date,
+                key="date_range"
+            )
+            # Пока выбрана только первая граница, date_input возвращает одну дату
+            period = period if isinstance(period, (tuple, list)) else (period,)
+            if period:
+                selected_days = days_between(date_index, period[0], period[-1])
+        
+        else:
+            # Дерево раскрывается по одному узлу: год -> месяц -> дни этого месяца
+            date_tree = create_date_tree(date_index)
+            year = st.sidebar.selectbox("Год:", sorted(date_tree.keys(), reverse=True), key="date_tree_year")
+            month = st.sidebar.selectbox(
+                "Месяц:",
+                sorted(date_tree[year].keys()),
+                index=len(date_tree[year]) - 1,
+                format_func=lambda m: months_dict[m],
+                key=f"date_tree_month_{year}"
+            )
+            month_days = sorted(day for days in date_tree[year][month].values() for day in days)
+            chosen_days = st.sidebar.multiselect("Дни:", month_days, default=month_days, key=f"date_tree_days_{year}_{month}")
+            selected_days = select_days(date_index, year, month) & np.isin(date_index["day"], chosen_days)
 
     # Показываем предупреждение, если ничего не выбрано
-    if not selected_dates:
+    if not selected_days.any():
         st.sidebar.warning("ℹ️ Не выбрано ни одной даты. Данные не будут отображаться.")
 
-    # Применяем фильтры
-    df_filtered = df[
-        (df["Время"].isin(selected_shifts)) &
-        (df["№ смены"].isin(selected_shift_numbers))
-    ].copy()
-    
-    # Применяем фильтр по датам только если есть выбранные даты
-    if selected_dates:
-        df_filtered = df_filtered[df_filtered["Дата"].isin(selected_dates)]
+    profiler.mark("Фильтрация")
+    # Применяем фильтры. Общий для сессий df не копируется: сессия хранит только
+    # номера выбранных строк, а страницы берут из них нужные столбцы
+    if df is None:
+        source_df = duckdb_store.filter_rows(date_index, cube, selected_days,
+                                             selected_shifts, selected_shift_numbers)
+        row_positions = np.arange(len(source_df))
     else:
-        # Если даты не выбраны, создаем пустой DataFrame с теми же колонками
-        df_filtered = pd.DataFrame(columns=df.columns)
+        source_df = df
+        row_positions = filter_positions(df, date_index, selected_days, selected_shifts, selected_shift_numbers)
+    
+    # Ключ состояния фильтров для кэшей производных результатов
+    filter_key = (
+        file_hash,
+        hashlib.sha1(np.packbits(selected_days).tobytes()).hexdigest(),
+        tuple(selected_shifts),
+        tuple(selected_shift_numbers),
+    )
 
     # Проверяем, есть ли данные для отображения
-    if df_filtered.empty:
+    if len(row_positions) == 0:
         st.info("📅 Выберите даты в сайдбаре для отображения данных")
         # Останавливаем выполнение кода дальше, чтобы не было ошибок
-        st.stop()
+        stop_run("пустая выборка", file=file_hash)
 
     # ======== БЛОК ИНФОРМАЦИИ О ДАННЫХ ========
+    profiler.mark("Информация о данных")
     st.title("📦 Дашборд по складу: динамика и показатели")
     
     # Информация о данных сразу под заголовком
@@ -387,11 +990,17 @@ if uploaded_file:
     col1, col2, col3 = st.columns(3)
     
     with col1:
+        if profile["memory_mb"] is None:
+            memory_text = "данные в DuckDB, в памяти только агрегаты"
+        else:
+            memory_text = (f"{profile['memory_mb']:.2f} МБ "
+                           f"(до сжатия типов: {profile['memory_before_mb']:.2f} МБ)")
         st.markdown(f"""
         <div class='info-card'>
             <h4>📁 Размер данных</h4>
-            <p><strong>Строк:</strong> {df.shape[0]}</p>
-            <p><strong>Столбцов:</strong> {df.shape[1]}</p>
+            <p><strong>Строк:</strong> {profile["rows"]}</p>
+            <p><strong>Столбцов:</strong> {len(profile["columns"])}</p>
+            <p><strong>Память:</strong> {memory_text}</p>
         </div>
         """, unsafe_allow_html=True)
     
@@ -399,17 +1008,17 @@ if uploaded_file:
         st.markdown(f"""
         <div class='info-card'>
             <h4>📅 Диапазон дат</h4>
-            <p><strong>Начало:</strong> {df['Дата'].min()}</p>
-            <p><strong>Конец:</strong> {df['Дата'].max()}</p>
+            <p><strong>Начало:</strong> {profile['start'].date()}</p>
+            <p><strong>Конец:</strong> {profile['end'].date()}</p>
         </div>
         """, unsafe_allow_html=True)
     
     with col3:
         numeric_count = len(numeric_cols)
-        categorical_count = df.shape[1] - numeric_count
+        categorical_count = len(profile["columns"]) - numeric_count
         
         # Информация о номерах смен
-        shift_counts = df["№ смены"].value_counts()
+        shift_counts = profile["shift_counts"]
         st.markdown(f"""
         <div class='info-card'>
             <h4>📈 Типы данных</h4>
@@ -422,324 +1031,65 @@ if uploaded_file:
     # Отображение списка столбцов
     st.markdown("#### 📋 Список столбцов")
     columns_info = []
-    for i, col in enumerate(df.columns, 1):
-        dtype = str(df[col].dtype)
-        non_null = df[col].count()
-        total = len(df)
+    for i, (col, dtype, non_null) in enumerate(profile["columns"], 1):
+        total = profile["rows"]
         columns_info.append(f"{i}. **{col}** (*{dtype}*) - {non_null}/{total} заполнено")
     
     st.write("\n".join(columns_info))
     
+    # Время разбора файла по этапам
+    with st.expander("⏱ Время загрузки файла"):
+        for stage, seconds in load_timings.items():
+            st.write(f"**{stage}:** {seconds:.3f} с")
+        
+        cache_stats = upload_cache.stats()
+        st.write(
+            f"**Кэш загрузок:** попаданий {cache_stats['hits']}, промахов {cache_stats['misses']}, "
+            f"записей {cache_stats['entries']}/{cache_stats['max_entries']}, "
+            f"{cache_stats['bytes'] / 1024 / 1024:.1f} МБ"
+        )
+    
     # Показываем уникальные значения времени и смен для проверки
     col1, col2 = st.columns(2)
     
     with col1:
         st.markdown("#### 🕐 Уникальные значения времени")
-        st.write(df["Время"].value_counts())
+        st.write(profile["time_counts"])
     
     with col2:
         st.markdown("#### 🔢 Уникальные значения смен")
-        st.write(df["№ смены"].value_counts().sort_index())
+        st.write(profile["shift_counts"])
     
     # Первые 5 строк
     st.markdown("#### 👀 Первые 5 строк данных")
-    st.dataframe(df.head(), use_container_width=True)
+    st.dataframe(profile["head"], use_container_width=True)
     
     st.markdown("---")
 
     # ======== KPI БЛОК ========
-    st.subheader("🔹 Сводные KPI за выбранный период")
-
-    def safe_sum(col):
-        return df_filtered[col].sum() if col in df_filtered.columns else 0
-
-    def safe_mean(col):
-        return df_filtered[col].mean() if col in df_filtered.columns else 0
-
-    total_turnover = safe_sum("Грузооборот всего")
-    avg_turnover = safe_mean("Грузооборот всего")
-    total_unloaded = safe_sum("Разгружено машин")
-    total_loaded = safe_sum("Загружено машин")
+    profiler.mark("KPI")
+    # Итоги считаются по ячейкам куба, а не по выбранным строкам
+    cube_selection = cube_cells(cube, selected_days, selected_shifts, selected_shift_numbers)
+    kpi_strip(cube, cube_selection)
 
-    col1, col2, col3, col4 = st.columns(4)
-    col1.markdown(f"<div class='kpi-card'><div class='kpi-value'>{total_turnover:,.0f}</div><div class='kpi-label'>Грузооборот всего</div></div>", unsafe_allow_html=True)
-    col2.markdown(f"<div class='kpi-card'><div class='kpi-value'>{avg_turnover:,.0f}</div><div class='kpi-label'>Средний грузооборот</div></div>", unsafe_allow_html=True)
-    col3.markdown(f"<div class='kpi-card'><div class='kpi-value'>{total_unloaded:,.0f}</div><div class='kpi-label'>Разгружено машин</div></div>", unsafe_allow_html=True)
-    col4.markdown(f"<div class='kpi-card'><div class='kpi-value'>{total_loaded:,.0f}</div><div class='kpi-label'>Загружено машин</div></div>", unsafe_allow_html=True)
-
-    # ======== ГЛАВНАЯ ========
+    # ======== СТРАНИЦЫ ========
+    profiler.mark(f"Страница «{page}»")
     if page == "Главная":
-        st.markdown("### 📋 Таблица по выбранным данным")
-        st.dataframe(df_filtered, use_container_width=True)
-
-    # ======== ДИНАМИКА ========
+        main_page(source_df, row_positions)
     elif page == "Динамика":
-        st.markdown("### 📈 Динамика показателей")
-        selected_metric = st.multiselect("Выберите показатели:", numeric_cols, default=["Грузооборот всего"])
-        if selected_metric:
-            long_df = pd.melt(df_filtered, id_vars=["Дата_Время"], value_vars=selected_metric,
-                              var_name="Показатель", value_name="Значение")
-            
-            # Столбчатая диаграмма
-            fig = px.bar(long_df, x="Дата_Время", y="Значение", color="Показатель",
-                         title="Изменения показателей по датам и времени",
-                         barmode='group')  # 'group' для группировки столбцов
-            
-            # Настройка внешнего вида
-            fig.update_layout(
-                xaxis_title="Дата и время",
-                yaxis_title="Значение",
-                legend_title="Показатели",
-                xaxis_tickangle=-45
-            )
-            
-            st.plotly_chart(fig, use_container_width=True)
-
-    # ======== ПРОЦЕНТНЫЕ ИЗМЕНЕНИЯ ========
+        dynamics_page(source_df, row_positions, cube, cube_selection, date_index, numeric_cols, filter_key)
     elif page == "Процентные изменения":
-        st.markdown("### 📊 Процентные изменения показателей")
-        df_change = df_filtered.copy()
-        for col in numeric_cols:
-            if col in df_change.columns:
-                df_change[f"Δ {col} (%)"] = df_change[col].pct_change() * 100
-        st.dataframe(df_change, use_container_width=True)
-
-    # ======== АНАЛИЗ ПО СМЕНАМ ========
+        changes_page(source_df, row_positions, cube, cube_selection, date_index, numeric_cols, filter_key)
     elif page == "Анализ по сменам":
-        st.markdown("## 🔄 Анализ по сменам")
-        
-        # Явно указываем столбцы которые у нас есть
-        vehicle_columns = [
-            'Разгружено машин', 
-            'Загружено машин', 
-            'Разгружено тракторов', 
-            'Загружено тракторов'
-        ]
-        
-        pallet_columns = [
-            'Принято паллет', 
-            'Отгружено паллет', 
-            'Паллет без системы'
-        ]
-        
-        employee_columns = [
-            'Старший смены',
-            'Помощник старшего смены', 
-            'Кладовщик',
-            'Водитель погрузчика',
-            'Рабочий склада',
-            'Всего сотрудников'
-        ]
-        
-        # Проверяем какие столбцы действительно есть в данных
-        existing_vehicle_cols = [col for col in vehicle_columns if col in df_filtered.columns]
-        existing_pallet_cols = [col for col in pallet_columns if col in df_filtered.columns]
-        existing_employee_cols = [col for col in employee_columns if col in df_filtered.columns]
-        
-        st.write(f"**Найдены столбцы транспорта:** {existing_vehicle_cols}")
-        st.write(f"**Найдены столбцы паллет:** {existing_pallet_cols}")
-        st.write(f"**Найдены столбцы сотрудников:** {existing_employee_cols}")
-        
-        # Проверяем наличие столбца с общим количеством сотрудников
-        if 'Всего сотрудников' not in df_filtered.columns:
-            st.error("❌ Столбец 'Всего сотрудников' не найден в данных!")
-            st.info("Доступные столбцы:")
-            st.write(list(df_filtered.columns))
-            st.stop()
-        
-        # Группируем по сменам
-        shift_analysis = df_filtered.groupby('№ смены').agg({
-            **{col: 'sum' for col in existing_vehicle_cols},
-            **{col: 'sum' for col in existing_pallet_cols},
-            **{col: 'sum' for col in existing_employee_cols},
-            'Грузооборот всего': 'sum'
-        }).reset_index()
-        
-        # Создаем две колонки для отображения
-        col1, col2 = st.columns(2)
-        
-        with col1:
-            st.markdown("### 🚛 Транспортные средства по сменам")
-            
-            if existing_vehicle_cols:
-                # Создаем график для транспортных средств
-                vehicle_melted = pd.melt(shift_analysis, 
-                                        id_vars=['№ смены'], 
-                                        value_vars=existing_vehicle_cols,
-                                        var_name='Тип транспорта', 
-                                        value_name='Количество')
-                
-                fig_vehicles = px.bar(vehicle_melted, 
-                                     x='№ смены', 
-                                     y='Количество', 
-                                     color='Тип транспорта',
-                                     title='Обработанные транспортные средства по сменам',
-                                     barmode='group')
-                
-                fig_vehicles.update_layout(
-                    xaxis_title="Номер смены",
-                    yaxis_title="Количество",
-                    legend_title="Тип транспорта"
-                )
-                
-                st.plotly_chart(fig_vehicles, use_container_width=True)
-                
-                # Таблица с детализацией
-                st.markdown("#### Детализация по транспортным средствам")
-                vehicle_table = shift_analysis[['№ смены'] + existing_vehicle_cols]
-                st.dataframe(vehicle_table, use_container_width=True)
-            else:
-                st.error("Не найдено столбцов с данными о транспортных средствах")
-        
-        with col2:
-            st.markdown("### 📦 Паллеты по сменам")
-            
-            if existing_pallet_cols:
-                # Создаем график для паллет
-                pallet_melted = pd.melt(shift_analysis, 
-                                       id_vars=['№ смены'], 
-                                       value_vars=existing_pallet_cols,
-                                       var_name='Тип операции', 
-                                       value_name='Количество')
-                
-                fig_pallets = px.bar(pallet_melted, 
-                                    x='№ смены', 
-                                    y='Количество', 
-                                    color='Тип операции',
-                                    title='Принятые и отгруженные паллеты по сменам',
-                                    barmode='group')
-                
-                fig_pallets.update_layout(
-                    xaxis_title="Номер смены",
-                    yaxis_title="Количество",
-                    legend_title="Тип операции"
-                )
-                
-                st.plotly_chart(fig_pallets, use_container_width=True)
-                
-                # Таблица с детализацией
-                st.markdown("#### Детализация по паллетам")
-                pallet_table = shift_analysis[['№ смены'] + existing_pallet_cols]
-                st.dataframe(pallet_table, use_container_width=True)
-            else:
-                st.error("Не найдено столбцов с данными о паллетах")
-        
-        # Детализация по сотрудникам
-        if len(existing_employee_cols) > 1:  # Если есть больше чем just 'Всего сотрудников'
-            st.markdown("### 👥 Детализация по сотрудникам по сменам")
-            
-            # Создаем график для сотрудников
-            employee_melted = pd.melt(shift_analysis, 
-                                     id_vars=['№ смены'], 
-                                     value_vars=[col for col in existing_employee_cols if col != 'Всего сотрудников'],
-                                     var_name='Должность', 
-                                     value_name='Количество')
-            
-            fig_employees = px.bar(employee_melted, 
-                                  x='№ смены', 
-                                  y='Количество', 
-                                  color='Должность',
-                                  title='Распределение сотрудников по должностям и сменам',
-                                  barmode='stack')
-            
-            fig_employees.update_layout(
-                xaxis_title="Номер смены",
-                yaxis_title="Количество сотрудников",
-                legend_title="Должность"
-            )
-            
-            st.plotly_chart(fig_employees, use_container_width=True)
-            
-            # Таблица с детализацией по сотрудникам
-            st.markdown("#### Детализация по сотрудникам")
-            employee_table = shift_analysis[['№ смены'] + existing_employee_cols]
-            st.dataframe(employee_table, use_container_width=True)
-        
-        # Сводная статистика по сменам
-        st.markdown("### 📊 Сводная статистика по сменам")
-        
-        # Создаем карточки с KPI для каждой смены
-        shifts = sorted(df_filtered['№ смены'].unique())
-        
-        for shift in shifts:
-            shift_data = df_filtered[df_filtered['№ смены'] == shift]
-            
-            st.markdown(f"#### Смена {shift}")
-            
-            # Создаем колонки для метрик
-            cols = st.columns(5)
-            
-            # Общее количество записей по смене
-            with cols[0]:
-                total_records = len(shift_data)
-                st.metric("Всего записей", total_records)
-            
-            # Транспортные средства
-            with cols[1]:
-                if existing_vehicle_cols:
-                    total_vehicles = shift_data[existing_vehicle_cols].sum().sum()
-                    st.metric("Всего транспорта", f"{total_vehicles:,.0f}")
-                else:
-                    st.metric("Всего транспорта", "Нет данных")
-            
-            # Паллеты
-            with cols[2]:
-                if existing_pallet_cols:
-                    total_pallets = shift_data[existing_pallet_cols].sum().sum()
-                    st.metric("Всего паллет", f"{total_pallets:,.0f}")
-                else:
-                    st.metric("Всего паллет", "Нет данных")
-            
-            # Грузооборот
-            with cols[3]:
-                total_turnover = shift_data['Грузооборот всего'].sum()
-                st.metric("Грузооборот", f"{total_turnover:,.0f}")
-            
-            # Состав смены - ТОЧНОЕ количество сотрудников из столбца 'Всего сотрудников'
-            with cols[4]:
-                # Суммируем сотрудников за все дни выбранного периода
-                total_team = shift_data['Всего сотрудников'].sum()
-                st.metric("Всего сотрудников", f"{total_team:,.0f}")
-        
-        # Дополнительная аналитика
-        st.markdown("### 📈 Сравнительный анализ смен")
-        
-        col1, col2 = st.columns(2)
-        
-        with col1:
-            # Эффективность по грузообороту на человека
-            shift_analysis['Эффективность'] = shift_analysis['Грузооборот всего'] / shift_analysis['Всего сотрудников']
-            
-            fig_efficiency = px.bar(shift_analysis, 
-                                   x='№ смены', 
-                                   y='Эффективность',
-                                   title='Эффективность по грузообороту на сотрудника по сменам',
-                                   color='Эффективность')
-            
-            st.plotly_chart(fig_efficiency, use_container_width=True)
-        
-        with col2:
-            # Общий грузооборот по сменам
-            fig_turnover = px.pie(shift_analysis, 
-                                 values='Грузооборот всего', 
-                                 names='№ смены',
-                                 title='Распределение грузооборота по сменам')
-            
-            st.plotly_chart(fig_turnover, use_container_width=True)
-        
-        # Детальная таблица всех показателей по сменам
-        st.markdown("### 📋 Полная сводка по сменам")
-        
-        # Переименовываем столбцы для лучшего отображения
-        display_columns = {
-            '№ смены': 'Смена',
-            'Грузооборот всего': 'Грузооборот',
-            'Всего сотрудников': 'Всего сотрудников',
-            'Эффективность': 'Эффективность (грузооборот/сотрудник)'
-        }
-        
-        shift_display = shift_analysis.rename(columns=display_columns)
-        st.dataframe(shift_display, use_container_width=True)
+        shifts_page(source_df, cube, cube_selection, filter_key)
+    elif page == "Тренды":
+        trends_page(cube, date_index, selected_days, selected_shift_numbers, filter_key)
+
+    # ======== ДИАГНОСТИКА ========
+    show_diagnostics(file=file_hash, rows=len(row_positions))
+
+elif watcher is not None:
+    st.info("📂 Загрузите Excel-файл или положите его в папку наблюдения: данные появятся после фонового разбора.")
 
 else:
     st.info("📁 Загрузите Excel-файл с листом 'Грузооборот' для начала.")
\ No newline at end of file
@@ -0,0 +1,140 @@
+import argparse
+import hashlib
+import json
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from datetime import datetime
+
+import numpy as np
+
+import processing
+from processing import (
+    cube_frame,
+    process_workbook,
+    save_snapshot,
+    shift_summary,
+    snapshot_path,
+)
+
+def output_paths(output_dir, name, file_hash):
+    """Файлы результатов одной книги: снимок по хэшу и таблицы агрегатов по имени книги"""
+    stem = os.path.splitext(name)[0]
+    return {
+        "snapshot": snapshot_path(file_hash, output_dir),
+        "cells": os.path.join(output_dir, f"{stem}.cells.csv"),
+        "shifts": os.path.join(output_dir, f"{stem}.shifts.csv"),
+    }
+
+def read_manifest(output_dir):
+    """Записи прошлого прогона по именам книг; пустой словарь, если manifest.json нет"""
+    path = os.path.join(output_dir, "manifest.json")
+    if not os.path.exists(path):
+        return {}
+    with open(path, encoding="utf-8") as f:
+        return {entry["file"]: entry for entry in json.load(f)["workbooks"]}
+
+def is_up_to_date(entry, file_hash, output_dir):
+    """Есть ли для книги с этим хэшем все результаты, записанные прошлым прогоном"""
+    if entry is None or entry.get("sha256") != file_hash or entry.get("status") not in ("готово", "пропущен"):
+        return False
+    # Результаты прежней версии очистки пересчитываются
+    if entry.get("cleaning") != processing.CLEANING_VERSION:
+        return False
+    # Таблицы смен у книг без нужных столбцов нет: в записи вместо имени файла None
+    outputs = [entry[key] for key in ("snapshot", "cells", "shifts") if entry.get(key)]
+    return all(os.path.exists(os.path.join(output_dir, name)) for name in outputs)
+
+def precompute_workbook(path, output_dir, force=False, streaming=False, previous=None):
+    """Обрабатывает одну книгу и пишет результаты; возвращает запись для manifest.json.
+
+    Снимок называется хэшем содержимого книги, как в кэше дашборда, поэтому
+    output_dir можно указать в DASHBOARD_SNAPSHOT_DIR и загрузка файла в
+    дашборде сведется к чтению снимка. previous - запись книги из прошлого
+    manifest.json: если книга не менялась и ее результаты на месте, она
+    пропускается.
+    """
+    name = os.path.basename(path)
+    with open(path, "rb") as f:
+        file_hash = hashlib.sha256(f.read()).hexdigest()
+    paths = output_paths(output_dir, name, file_hash)
+    entry = {"file": name, "sha256": file_hash, "cleaning": processing.CLEANING_VERSION,
+             **{k: os.path.basename(v) for k, v in paths.items()}}
+    
+    if not force and is_up_to_date(previous, file_hash, output_dir):
+        return {**previous, "status": "пропущен"}
+    
+    # Одна битая книга или неудачная запись не должны останавливать ночной прогон
+    try:
+        result = process_workbook(path, streaming=streaming)
+        df, cube = result["df"], result["cube"]
+        columns = list(cube["sum"].columns)
+        save_snapshot(df, file_hash, output_dir)
+        # utf-8-sig, чтобы Excel открывал таблицы с кириллицей без настройки кодировки
+        cube_frame(cube, result["date_index"]).to_csv(paths["cells"], index=False, encoding="utf-8-sig")
+        if "Грузооборот всего" in columns and "Всего сотрудников" in columns:
+            all_cells = np.ones(len(cube["day"]), dtype=bool)
+            shift_summary(cube, all_cells, columns).to_csv(paths["shifts"], index=False, encoding="utf-8-sig")
+        else:
+            entry["shifts"] = None
+    except Exception as e:
+        entry["status"] = "ошибка"
+        entry["error"] = f"{type(e).__name__}: {e}"
+        return entry
+    
+    entry.update({
+        "status": "готово",
+        "rows": len(df),
+        "days": len(result["date_index"]["dates"]),
+        "timings": result["timings"],
+    })
+    return entry
+
+def main():
+    parser = argparse.ArgumentParser(description="Предрасчет снимков и агрегатов для папки книг Грузооборот")
+    parser.add_argument("input_dir", help="папка с книгами .xlsx")
+    parser.add_argument("output_dir", help="куда писать снимки (.arrow) и агрегаты (.csv)")
+    parser.add_argument("--workers", type=int, default=None, help="число процессов, по умолчанию по числу ядер")
+    parser.add_argument("--force", action="store_true", help="пересчитать книги, для которых результаты уже есть")
+    parser.add_argument("--streaming", action="store_true", help="читать книги потоково, с ограниченной памятью")
+    args = parser.parse_args()
+    
+    if processing.pa is None:
+        parser.error("для записи снимков нужен пакет pyarrow")
+    
+    # Временные файлы Excel (~$книга.xlsx) не являются книгами
+    paths = sorted(
+        os.path.join(args.input_dir, name) for name in os.listdir(args.input_dir)
+        if name.lower().endswith(".xlsx") and not name.startswith("~$")
+    )
+    if not paths:
+        parser.error(f"в {args.input_dir} нет файлов .xlsx")
+    os.makedirs(args.output_dir, exist_ok=True)
+    
+    started = time.perf_counter()
+    previous = read_manifest(args.output_dir)
+    entries = []
+    with ProcessPoolExecutor(max_workers=args.workers) as pool:
+        futures = [pool.submit(precompute_workbook, path, args.output_dir, args.force, args.streaming,
+                               previous.get(os.path.basename(path)))
+                   for path in paths]
+        for future in as_completed(futures):
+            entry = future.result()
+            entries.append(entry)
+            print(f"{entry['file']}: {entry['status']}" + (f" ({entry['error']})" if "error" in entry else ""),
+                  file=sys.stderr)
+    
+    manifest = {
+        "created": datetime.now().isoformat(timespec="seconds"),
+        "seconds": time.perf_counter() - started,
+        "workbooks": sorted(entries, key=lambda entry: entry["file"]),
+    }
+    with open(os.path.join(args.output_dir, "manifest.json"), "w", encoding="utf-8") as f:
+        json.dump(manifest, f, ensure_ascii=False, indent=2)
+    
+    if any(entry["status"] == "ошибка" for entry in entries):
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,1579 @@
+import functools
+import hashlib
+import io
+import itertools
+import json
+import os
+import re
+import threading
+import time
+import tracemalloc
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+
+import numpy as np
+import openpyxl
+import pandas as pd
+from pandas.io.parsers import TextParser
+
+try:
+    import pyarrow as pa
+except ImportError:  # снимки в формате Arrow необязательны
+    pa = None
+
+try:
+    import duckdb
+except ImportError:  # SQL-бэкенд необязателен
+    duckdb = None
+
+
+# ==================== ЗАГРУЗКА ======================
+class HeaderNotFoundError(ValueError):
+    """В первых строках листа нет строки с заголовками (Дата, Время, № смены)"""
+
+    def __init__(self, preview):
+        super().__init__("Не удалось найти строку с заголовками (Дата, Время, № смены)")
+        self.preview = preview
+
+class MissingColumnsError(ValueError):
+    """На листе нет обязательных столбцов; found - столбцы, которые нашлись"""
+
+    def __init__(self, missing, found):
+        super().__init__(f"Не найдены необходимые столбцы: {missing}")
+        self.missing = missing
+        self.found = found
+
+def ignore_progress(stage, rows=None, total_rows=None):
+    """Обработчик прогресса по умолчанию: загрузка без отчета об этапах"""
+
+EMPLOYEE_COLUMNS = [
+    'Старший смены', 'Помощник старшего смены', 'Кладовщик', 
+    'Водитель погрузчика', 'Рабочий склада', 'Всего сотрудников'
+]
+
+def find_header_row(df_raw):
+    """Номер строки с основными заголовками (Дата, Время, № смены) среди первых 5 или None"""
+    for i in range(min(5, len(df_raw))):
+        row_values = df_raw.iloc[i].dropna().astype(str).str.strip().tolist()
+        if 'Дата' in row_values and 'Время' in row_values and '№ смены' in row_values:
+            return i
+    return None
+
+def read_sheet_rows(uploaded_file):
+    """Читает лист Грузооборот за один проход и возвращает сырые строки ячеек"""
+    # dtype=object и na_filter=False сохраняют значения ячеек как есть,
+    # чтобы дальше разбирать строки так же, как это делает pd.read_excel
+    grid = pd.read_excel(uploaded_file, sheet_name="Грузооборот", header=None,
+                         dtype=object, na_filter=False)
+    return grid.values.tolist()
+
+def frame_from_rows(rows, header=None):
+    """Строит DataFrame из сырых строк листа, как pd.read_excel(header=header)"""
+    if not rows:
+        return pd.DataFrame()
+    return TextParser(rows, header=header, skip_blank_lines=False).read()
+
+def load_excel_separately(uploaded_file, timings=None, progress=None):
+    """Загружает основные столбцы и подстолбцы отдельно, затем объединяет.
+
+    Лист читается один раз; обе строки заголовков ищутся в уже разобранной сетке.
+    Если передан словарь timings, в него записывается время каждого этапа (сек),
+    progress(stage) вызывается перед этапами. Без строки заголовков выбрасывает
+    HeaderNotFoundError, ошибки чтения файла пробрасываются как есть.
+    """
+    if timings is None:
+        timings = {}
+    if progress is None:
+        progress = ignore_progress
+    # Читаем лист целиком один раз
+    progress("Чтение листа")
+    started = time.perf_counter()
+    rows = read_sheet_rows(uploaded_file)
+    timings["Чтение листа"] = time.perf_counter() - started
+
+    # Первые 5 строк, чтобы увидеть структуру
+    started = time.perf_counter()
+    df_raw = frame_from_rows(rows[:5])
+    
+    # Ищем строку с основными заголовками (Дата, Время, № смены)
+    header_row = find_header_row(df_raw)
+    timings["Поиск заголовков"] = time.perf_counter() - started
+    
+    if header_row is None:
+        raise HeaderNotFoundError(df_raw)
+    
+    # Основные данные начиная с найденной строки заголовков
+    progress("Основные столбцы", 0, len(rows) - header_row - 1)
+    started = time.perf_counter()
+    df_main = frame_from_rows(rows, header=header_row)
+    
+    # Убираем пустые строки и Unnamed колонки; drop дает собственный DataFrame,
+    # поэтому столбцы сотрудников ниже добавляются без лишней копии
+    df_main.dropna(how="all", inplace=True)
+    df_main = df_main.drop(columns=df_main.columns[df_main.columns.str.contains("Unnamed", na=False)])
+    timings["Основные столбцы"] = time.perf_counter() - started
+    
+    # Теперь разбираем подстолбцы сотрудников из той же сетки
+    # Предполагаем, что подстолбцы находятся в следующей строке после заголовков
+    progress("Столбцы сотрудников")
+    started = time.perf_counter()
+    employee_header_row = header_row + 1
+    df_employees_raw = frame_from_rows(rows, header=employee_header_row)
+    
+    # Ищем столбцы сотрудников в данных
+    employee_data = {}
+    for col in EMPLOYEE_COLUMNS:
+        if col in df_employees_raw.columns:
+            employee_data[col] = df_employees_raw[col]
+    
+    # Если нашли столбцы сотрудников, добавляем их к основным данным
+    if employee_data:
+        employee_df = pd.DataFrame(employee_data)
+        
+        # Подстолбцы начинаются на строку ниже основных данных: сопоставляем
+        # по строке листа, а не по позиции, иначе сотрудники съезжают на смену
+        employee_df.index += employee_header_row - header_row
+        employee_df = employee_df.reindex(df_main.index)
+        
+        # Объединяем данные
+        for col in EMPLOYEE_COLUMNS:
+            if col in employee_df.columns:
+                df_main[col] = employee_df[col].values
+    timings["Столбцы сотрудников"] = time.perf_counter() - started
+    
+    return df_main
+
+def stream_excel(source, timings=None, chunk_rows=10_000, progress=None):
+    """Потоковая загрузка и очистка листа Грузооборот для очень больших книг.
+
+    Лист читается openpyxl в режиме read_only построчно, строки разбираются
+    пачками по chunk_rows сразу в типизированные буферы столбцов: даты с
+    заполнением объединенных ячеек, коды времени и номера смены, float64 для
+    чисел. Сырые строки листа целиком в памяти не держатся. Результат тот же,
+    что у clean_data(load_excel_separately(...)). progress(stage, rows, total_rows)
+    вызывается после каждой пачки; total_rows берется из размеров листа и может
+    быть None, если книга их не хранит.
+    """
+    if timings is None:
+        timings = {}
+    if progress is None:
+        progress = ignore_progress
+    progress("Поиск заголовков")
+    started = time.perf_counter()
+    wb = openpyxl.load_workbook(source, read_only=True, data_only=True, keep_links=False)
+    try:
+        sheet = wb["Грузооборот"]
+        rows = sheet.iter_rows(values_only=True)
+        
+        # Заголовки ищем так же, как в load_excel_separately: пустые ячейки
+        # заменяем на "" и выравниваем строки по ширине, как read_sheet_rows
+        head = list(itertools.islice(rows, 6))
+        width = max((len(row) for row in head), default=0)
+        head = [["" if v is None else v for v in row] + [""] * (width - len(row)) for row in head]
+        df_raw = frame_from_rows(head[:5])
+        header_row = find_header_row(df_raw)
+        if header_row is None:
+            raise HeaderNotFoundError(df_raw)
+        
+        # Позиции нужных столбцов: основные без Unnamed, затем подстолбцы сотрудников
+        names = list(frame_from_rows(head[header_row:header_row + 1], header=0).columns)
+        positions = {name: i for i, name in enumerate(names) if "Unnamed" not in str(name)}
+        if header_row + 1 < len(head):
+            employee_names = list(frame_from_rows(head[header_row + 1:header_row + 2], header=0).columns)
+            for col in EMPLOYEE_COLUMNS:
+                if col in employee_names:
+                    positions[col] = employee_names.index(col)
+        missing_columns = [col for col in REQUIRED_COLUMNS if col not in positions]
+        if missing_columns:
+            raise MissingColumnsError(missing_columns, list(positions))
+        numeric_columns = [col for col in positions if col not in REQUIRED_COLUMNS]
+        timings["Поиск заголовков"] = time.perf_counter() - started
+        
+        started = time.perf_counter()
+        # Значения времени и смены повторяются, поэтому разбираем каждое один раз
+        time_cache, shift_cache = {}, {}
+        time_labels, shift_labels = {}, {}
+        buffers = {
+            "index": [np.empty(0, dtype=np.int64)],
+            "Дата": [np.empty(0, dtype="datetime64[ns]")],
+            "Время": [np.empty(0, dtype=np.int32)],
+            "№ смены": [np.empty(0, dtype=np.int32)],
+            **{col: [np.empty(0, dtype=np.int8)] for col in numeric_columns},
+        }
+        last_date = None
+        first_label = 0
+        width = max(positions.values()) + 1  # хватает до последнего нужного столбца
+        
+        def code(value, cache, labels, func):
+            if value not in cache:
+                # Пустая строка в ячейке - такой же пропуск, как пустая ячейка
+                label = func(None if value == "" else value)
+                cache[value] = -1 if label is None else labels.setdefault(label, len(labels))
+            return cache[value]
+        
+        data_rows = itertools.chain(head[header_row + 1:], rows)
+        total_rows = sheet.max_row - header_row - 1 if sheet.max_row else None
+        progress("Чтение и разбор строк", 0, total_rows)
+        while True:
+            chunk = list(itertools.islice(data_rows, chunk_rows))
+            if not chunk:
+                break
+            chunk = [row if len(row) >= width else tuple(row) + (None,) * (width - len(row)) for row in chunk]
+            
+            # Объединенные ячейки даты: протягиваем последнюю дату, в том числе между пачками
+            dates = []
+            for row in chunk:
+                value = row[positions["Дата"]]
+                if value is not None and value != "":
+                    last_date = value
+                dates.append(last_date)
+            
+            shift_codes = np.array([code(row[positions["№ смены"]], shift_cache, shift_labels, convert_shift)
+                                    for row in chunk], dtype=np.int32)
+            time_codes = np.array([code(row[positions["Время"]], time_cache, time_labels, normalize_time_str)
+                                   for row in chunk], dtype=np.int32)
+            dates = pd.to_datetime(pd.Series(dates, dtype=object), errors="coerce").dt.normalize().values
+            
+            # Строки без распознанной смены или даты отбрасываются, как в clean_data
+            keep = (shift_codes >= 0) & ~np.isnat(dates)
+            buffers["index"].append(np.flatnonzero(keep) + first_label)
+            buffers["Дата"].append(dates[keep])
+            buffers["Время"].append(time_codes[keep])
+            buffers["№ смены"].append(shift_codes[keep])
+            # Целые пачки без пропусков сразу храним в минимальной разрядности;
+            # np.concatenate потом сам приведет пачки к общему типу
+            for col in numeric_columns:
+                values = pd.Series([row[positions[col]] for row in chunk], dtype=object)
+                values = pd.to_numeric(values, errors="coerce").to_numpy("float64", na_value=np.nan)[keep]
+                buffers[col].append(pd.to_numeric(values, downcast="integer"))
+            first_label += len(chunk)
+            progress("Чтение и разбор строк", first_label, total_rows)
+    finally:
+        wb.close()
+    timings["Чтение и разбор строк"] = time.perf_counter() - started
+    
+    progress("Сортировка и сжатие типов")
+    started = time.perf_counter()
+    columns = {col: np.concatenate(parts) for col, parts in buffers.items()}
+    index = columns.pop("index")
+    # Код -1 - пропуск, как у map_distinct для нераспознанных значений
+    columns["Время"] = pd.Categorical.from_codes(columns["Время"], categories=list(time_labels))
+    columns["№ смены"] = pd.Categorical.from_codes(columns["№ смены"], categories=list(shift_labels))
+    df = pd.DataFrame(columns, index=index)[list(positions)]
+    
+    # Обычно лист уже идет по датам, тогда сортировка (и ее копия) не нужна
+    if not df["Дата"].is_monotonic_increasing:
+        df = df.sort_values("Дата", kind="stable")
+    df.attrs["memory_before"] = int(df.memory_usage(deep=True).sum())
+    df = compact_dtypes(df)
+    timings["Сортировка и сжатие типов"] = time.perf_counter() - started
+    
+    return df
+
+
+# ==================== ОЧИСТКА ======================
+# Версия загрузки и очистки: повышается при каждом изменении, меняющем очищенные
+# данные. Входит в имена снимков и в манифесты истории и DuckDB, чтобы данные,
+# очищенные прежним кодом, не выдавались за результат нового.
+#   1 - исходная очистка
+#   2 - столбцы сотрудников выровнены по строкам листа
+CLEANING_VERSION = 2
+
+def normalize_time_str(time_str):
+    """Приводит формат времени к виду 6:00-18:00 / 18:00-6:00"""
+    if pd.isna(time_str):
+        return None
+    
+    s = str(time_str).strip()
+    
+    # Если уже в правильном формате, возвращаем как есть
+    if s in ["6:00-18:00", "18:00-6:00"]:
+        return s
+    
+    # Заменяем различные типы дефисов и убираем пробелы
+    s = s.replace("–", "-").replace("—", "-").replace(" ", "")
+    s = s.replace(".", ":")
+    
+    # Извлекаем числа из строки
+    numbers = re.findall(r'\d+', s)
+    
+    if len(numbers) >= 2:
+        first_num = int(numbers[0])
+        second_num = int(numbers[1])
+        
+        # Определяем формат на основе первого числа
+        if first_num == 6:
+            return "6:00-18:00"
+        elif first_num == 18:
+            return "18:00-6:00"
+    
+    # Если не удалось определить, возвращаем исходное значение
+    return s
+
+def map_distinct(series, func, categorical=False):
+    """Применяет func один раз к каждому уникальному значению и размечает столбец целиком.
+
+    Результат совпадает с series.apply(func) для функций, которые зависят только
+    от str(значения) и возвращают одно и то же для всех пропусков.
+    """
+    keys = series
+    if pd.api.types.infer_dtype(series, skipna=True) not in ("string", "empty"):
+        # factorize считает 1, 1.0 и True одним значением, а str() - нет
+        keys = series.where(series.isna(), series.astype(str))
+    
+    codes, uniques = pd.factorize(keys)
+    # Последний элемент - результат для пропусков (код -1)
+    resolved = [func(value) for value in uniques] + [func(np.nan)]
+    
+    if categorical:
+        result_codes, categories = pd.factorize(pd.Series(resolved, dtype=object))
+        values = pd.Categorical.from_codes(result_codes[codes], categories=categories)
+        return pd.Series(values, index=series.index, name=series.name)
+    
+    values = np.empty(len(resolved), dtype=object)
+    values[:] = resolved
+    return pd.Series(values[codes], index=series.index, name=series.name)
+
+def process_merged_cells(df):
+    """Обрабатывает объединенные ячейки в столбце Дата (изменяет df на месте)"""
+    # Заполняем пропущенные даты предыдущими значениями
+    df["Дата"] = df["Дата"].ffill()
+    
+    return df
+
+# Словарь для преобразования букв смен в цифры
+SHIFT_MAPPING = {
+    'А': '1', 'A': '1',  # Кириллическая и латинская A
+    'Б': '2', 'B': '2',  # Кириллическая Б и латинская B
+    'В': '3', 'C': '3',  # Кириллическая В и латинская C
+    'Г': '4', 'D': '4',  # Кириллическая Г и латинская D
+}
+
+def convert_shift(value):
+    """Номер смены '1'-'4' из цифры или буквы; None, если значение не распознано"""
+    if pd.isna(value) or value is None or value == '':
+        return None
+    
+    value_str = str(value).strip().upper()
+    
+    # Если значение уже цифра от 1 до 4, оставляем как есть
+    if value_str in ['1', '2', '3', '4']:
+        return value_str
+    
+    # Если значение буква, преобразуем по словарю
+    if value_str in SHIFT_MAPPING:
+        return SHIFT_MAPPING[value_str]
+    
+    # Если значение не распознано, возвращаем None
+    return None
+
+def process_shift_numbers(df):
+    """Преобразует буквы смен в цифры на месте; нераспознанные номера становятся None.
+
+    Строки с None удаляет clean_data вместе со строками без даты, одной выборкой.
+    """
+    df["№ смены"] = map_distinct(df["№ смены"], convert_shift)
+    
+    return df
+
+def clean_data(df, timings=None):
+    """Очищает загруженные данные: даты, номера смен, время и числовые столбцы.
+
+    Шаги меняют столбцы df на месте, строки без смены или даты отбрасываются
+    одной выборкой вместе с сортировкой. Если передан словарь timings, в него
+    записывается время каждого шага (сек).
+    """
+    if timings is None:
+        timings = {}
+    
+    # Обрабатываем объединенные ячейки в столбце Дата
+    started = time.perf_counter()
+    df = process_merged_cells(df)
+    timings["Объединенные ячейки"] = time.perf_counter() - started
+    
+    # Обрабатываем номера смен
+    started = time.perf_counter()
+    df = process_shift_numbers(df)
+    timings["Номера смен"] = time.perf_counter() - started
+
+    # Преобразуем дату (datetime64 без времени суток вместо объектов date)
+    started = time.perf_counter()
+    df["Дата"] = pd.to_datetime(df["Дата"], errors="coerce").dt.normalize()
+    timings["Даты"] = time.perf_counter() - started
+
+    # Преобразуем время
+    started = time.perf_counter()
+    df["Время"] = map_distinct(df["Время"], normalize_time_str)
+    timings["Время смены"] = time.perf_counter() - started
+
+    # Преобразуем числовые столбцы
+    started = time.perf_counter()
+    df = coerce_numeric(df)
+    timings["Числовые столбцы"] = time.perf_counter() - started
+
+    # Отбрасываем строки без смены или даты и сортируем по дате, чтобы выбор
+    # дней сводился к срезам строк; строки копируются один раз
+    started = time.perf_counter()
+    keep = np.flatnonzero(df["№ смены"].notna().values & df["Дата"].notna().values)
+    order = np.argsort(df["Дата"].values[keep], kind="stable")
+    df = df.take(keep[order])
+
+    df.attrs["memory_before"] = int(df.memory_usage(deep=True).sum())
+    df = compact_dtypes(df)
+    timings["Сортировка и сжатие типов"] = time.perf_counter() - started
+    
+    return df
+
+def coerce_numeric(df):
+    """Преобразует все столбцы, кроме Дата/Время/№ смены, в числа (на месте).
+
+    Уже числовые столбцы не трогаются, остальные переводятся одним блоком:
+    текст формул (начинается с =) и прочие нечисла становятся NaN.
+    """
+    columns = [col for col in df.columns
+               if col not in ["Дата", "Время", "№ смены"] and not pd.api.types.is_numeric_dtype(df[col])]
+    if columns:
+        block = df[columns].to_numpy(dtype=object)
+        values = pd.to_numeric(block.ravel(), errors="coerce").reshape(block.shape)
+        df[columns] = values
+    
+    return df
+
+def compact_dtypes(df):
+    """Сжимает типы: категории для времени и номера смены, целые минимальной разрядности"""
+    for col in ["Время", "№ смены"]:
+        values = df[col].astype("category").cat.remove_unused_categories()
+        df[col] = values.cat.reorder_categories(sorted(values.cat.categories))
+    
+    # Счетчики без пропусков и дробной части хранятся как int8/int16/int32
+    for col in df.select_dtypes(include="number").columns:
+        df[col] = pd.to_numeric(df[col], downcast="integer")
+    
+    return df
+
+def date_time_label(df):
+    """Подпись «дата время» для графиков; строится только для переданных строк"""
+    return df["Дата"].dt.strftime("%Y-%m-%d") + " " + df["Время"].astype(str)
+
+def shift_timestamps(df):
+    """Момент начала смены для каждой строки: дата плюс первый час из "Время" """
+    hours = [int(m.group(1)) if (m := re.match(r"(\d+)", str(c))) else 0 for c in df["Время"].cat.categories]
+    codes = df["Время"].cat.codes.values
+    offsets = np.append(np.array(hours, dtype=np.int64), 0)[codes]
+    return df["Дата"] + pd.to_timedelta(offsets, unit="h")
+
+def memory_mb(df):
+    """Объем DataFrame в памяти в мегабайтах"""
+    return df.memory_usage(deep=True).sum() / 1024 / 1024
+
+def dataset_profile(df):
+    """Сводка для блока информации о данных: размер, столбцы, диапазон дат, значения смен"""
+    return {
+        "rows": len(df),
+        "columns": [(col, str(df[col].dtype), int(df[col].count())) for col in df.columns],
+        "memory_mb": memory_mb(df),
+        "memory_before_mb": df.attrs.get("memory_before", 0) / 1024 / 1024,
+        "start": df["Дата"].min(),
+        "end": df["Дата"].max(),
+        "time_counts": df["Время"].value_counts(),
+        "shift_counts": df["№ смены"].value_counts().sort_index(),
+        "head": df.head(),
+    }
+
+
+# ==================== ИНДЕКС ДАТ И ФИЛЬТРЫ ======================
+def build_date_index(df):
+    """Индекс по дате для отсортированного по "Дата" df.
+
+    Для каждого уникального дня хранит границы его строк (starts/ends) и
+    компоненты даты, чтобы выбор дней переводился в срезы строк.
+    """
+    days = df["Дата"].values.astype("datetime64[D]")
+    starts = np.flatnonzero(np.r_[True, days[1:] != days[:-1]]) if len(days) else np.array([], dtype=np.int64)
+    return date_index_from_days(pd.DatetimeIndex(days[starts]), starts, len(days))
+
+def date_index_from_days(dates, starts, total_rows):
+    """Индекс дат из уникальных дней и номеров первых строк каждого дня"""
+    iso = dates.isocalendar()
+    
+    return {
+        "dates": dates,
+        "starts": starts,
+        "ends": np.r_[starts[1:], total_rows].astype(np.int64),
+        "year": dates.year.values,
+        "month": dates.month.values,
+        "iso_year": iso.year.values.astype(np.int64),
+        "week": iso.week.values.astype(np.int64),
+        "day": dates.day.values,
+    }
+
+def create_date_tree(date_index):
+    """Создает дерево дат для фильтрации: Год -> Месяц -> Неделя -> День"""
+    parts = pd.DataFrame({
+        "year": date_index["year"],
+        "month": date_index["month"],
+        "week": date_index["week"],
+        "day": date_index["day"],
+    })
+    
+    date_tree = {}
+    
+    # Дни уже отсортированы, поэтому списки дней в неделях тоже упорядочены
+    for (year, month, week), days in parts.groupby(["year", "month", "week"], sort=True)["day"]:
+        date_tree.setdefault(int(year), {}).setdefault(int(month), {})[int(week)] = days.tolist()
+    
+    return date_tree
+
+def select_days(date_index, year, month=None, week=None, day=None):
+    """Битовая маска уникальных дней индекса, попадающих в год/месяц/неделю/день"""
+    mask = date_index["year"] == year
+    if month is not None:
+        mask &= date_index["month"] == month
+    if week is not None:
+        mask &= date_index["week"] == week
+    if day is not None:
+        mask &= date_index["day"] == day
+    return mask
+
+def days_between(date_index, start, end):
+    """Битовая маска уникальных дней индекса в диапазоне [start, end]"""
+    dates = date_index["dates"]
+    first = dates.searchsorted(pd.Timestamp(start), side="left")
+    last = dates.searchsorted(pd.Timestamp(end), side="right")
+    mask = np.zeros(len(dates), dtype=bool)
+    mask[first:last] = True
+    return mask
+
+def category_mask(categories, selected):
+    """Таблица допустимых кодов категорий; последний элемент отвечает пропуску (код -1)"""
+    return np.append(categories.isin(selected), False)
+
+def filter_positions(df, date_index, selected_days, selected_shifts, selected_shift_numbers):
+    """Номера строк df под маску дней, времени и номера смены.
+
+    Непрерывные серии выбранных дней превращаются в срезы строк индекса,
+    а смены проверяются по кодам категорий только внутри этих срезов.
+    """
+    time_codes = df["Время"].cat.codes.values
+    number_codes = df["№ смены"].cat.codes.values
+    allowed_time = category_mask(df["Время"].cat.categories, selected_shifts)
+    allowed_number = category_mask(df["№ смены"].cat.categories, selected_shift_numbers)
+    
+    edges = np.flatnonzero(np.diff(np.r_[0, selected_days.astype(np.int8), 0]))
+    chunks = []
+    for first, last in zip(edges[::2], edges[1::2]):
+        row_start = date_index["starts"][first]
+        row_end = date_index["ends"][last - 1]
+        keep = (allowed_time[time_codes[row_start:row_end]]
+                & allowed_number[number_codes[row_start:row_end]])
+        chunks.append(row_start + np.flatnonzero(keep))
+    
+    return np.concatenate(chunks) if chunks else np.array([], dtype=np.int64)
+
+def filter_rows(df, date_index, selected_days, selected_shifts, selected_shift_numbers):
+    """Отбирает строки по маске дней, времени и номеру смены (копия выбранных строк)"""
+    return df.iloc[filter_positions(df, date_index, selected_days, selected_shifts, selected_shift_numbers)]
+
+def take_rows(df, positions, columns=None):
+    """Строки positions только нужных столбцов, без копии остальных столбцов df"""
+    if columns is None:
+        return df.iloc[positions]
+    return df.iloc[positions, df.columns.get_indexer(columns)]
+
+
+# ==================== АГРЕГАТЫ ======================
+def build_cube(df, date_index):
+    """Куб агрегатов по (день, время, номер смены) для всех числовых столбцов.
+
+    Для каждой ячейки хранятся суммы, количества непустых значений и суммы
+    квадратов, так что итоги по любому набору фильтров получаются сложением ячеек.
+    """
+    columns = [c for c in df.select_dtypes(include="number").columns if c != "№ смены"]
+    values = df[columns]
+    
+    # df отсортирован по дате, поэтому номер дня строки восстанавливается из границ индекса
+    keys = [
+        np.repeat(np.arange(len(date_index["starts"])), date_index["ends"] - date_index["starts"]),
+        df["Время"].cat.codes.values,
+        df["№ смены"].cat.codes.values,
+    ]
+    sums = values.groupby(keys, sort=True).sum()
+    counts = values.groupby(keys, sort=True).count()
+    rows = values.groupby(keys, sort=True).size()
+    sumsq = values.astype("float64").pow(2).groupby(keys, sort=True).sum()
+    
+    return {
+        "day": sums.index.get_level_values(0).values,
+        "time": sums.index.get_level_values(1).values,
+        "number": sums.index.get_level_values(2).values,
+        "time_categories": df["Время"].cat.categories,
+        "number_categories": df["№ смены"].cat.categories,
+        "sum": sums.reset_index(drop=True),
+        "count": counts.reset_index(drop=True),
+        "sumsq": sumsq.reset_index(drop=True),
+        "rows": rows.values,
+    }
+
+def cube_cells(cube, selected_days, selected_shifts, selected_shift_numbers):
+    """Маска ячеек куба, попадающих под фильтры сайдбара"""
+    allowed_time = category_mask(cube["time_categories"], selected_shifts)
+    allowed_number = category_mask(cube["number_categories"], selected_shift_numbers)
+    return selected_days[cube["day"]] & allowed_time[cube["time"]] & allowed_number[cube["number"]]
+
+def cube_by_shift(cube, cells, columns):
+    """Суммы столбцов по номеру смены из ячеек куба, как groupby('№ смены').sum()"""
+    grouped = cube["sum"].loc[cells, columns].groupby(cube["number"][cells], sort=True).sum()
+    result = grouped.reset_index(drop=True)
+    result.insert(0, "№ смены", pd.Categorical.from_codes(grouped.index.values, categories=cube["number_categories"]))
+    return result
+
+def shift_summary(cube, cells, columns):
+    """Сводка по сменам за один проход по кубу: суммы, число записей и эффективность"""
+    summary = cube_by_shift(cube, cells, columns)
+    
+    # Порядок групп тот же, что в cube_by_shift: по коду номера смены
+    numbers = cube["number"][cells]
+    summary["Всего записей"] = pd.Series(cube["rows"][cells]).groupby(numbers, sort=True).sum().values
+    
+    # Грузооборот на сотрудника; при нуле сотрудников значение не определено
+    staff = summary["Всего сотрудников"]
+    summary["Эффективность"] = summary["Грузооборот всего"] / staff.where(staff != 0)
+    
+    return summary
+
+def dynamics_frame(df_filtered, cube, cells, date_index, metrics, bucket):
+    """Ряды для графика "Динамика" в длинном формате: Дата_Время, Показатель, Значение.
+
+    bucket: "shift" - строки как есть, "day"/"week"/"month" - суммы из куба
+    агрегатов по дням, неделям ISO (с понедельника) или месяцам.
+    """
+    if bucket == "shift":
+        wide = df_filtered[metrics].assign(Дата_Время=shift_timestamps(df_filtered))
+    else:
+        dates = date_index["dates"][cube["day"][cells]]
+        if bucket == "week":
+            dates = dates.to_period("W-SUN").start_time
+        elif bucket == "month":
+            dates = dates.to_period("M").start_time
+        wide = cube["sum"].loc[cells, metrics].groupby(dates.values, sort=True).sum()
+        wide = wide.rename_axis("Дата_Время").reset_index()
+    
+    return pd.melt(wide, id_vars=["Дата_Время"], value_vars=metrics,
+                   var_name="Показатель", value_name="Значение")
+
+def lttb_indices(x, y, threshold):
+    """Индексы точек, которые оставляет прореживание Largest-Triangle-Three-Buckets"""
+    n = len(x)
+    if threshold >= n or threshold < 3:
+        return np.arange(n)
+    
+    every = (n - 2) / (threshold - 2)
+    selected = np.empty(threshold, dtype=np.int64)
+    selected[0] = 0
+    anchor = 0
+    for i in range(threshold - 2):
+        start = int(i * every) + 1
+        end = int((i + 1) * every) + 1
+        # Третья вершина треугольника - среднее следующей корзины
+        next_end = min(int((i + 2) * every) + 1, n)
+        avg_x = x[end:next_end].mean()
+        avg_y = y[end:next_end].mean()
+        areas = np.abs((x[anchor] - avg_x) * (y[start:end] - y[anchor])
+                       - (x[anchor] - x[start:end]) * (avg_y - y[anchor]))
+        anchor = start + int(areas.argmax())
+        selected[i + 1] = anchor
+    selected[-1] = n - 1
+    return selected
+
+def downsample_long(long_df, max_points):
+    """Прореживает каждый показатель длинной таблицы до max_points точек (LTTB)"""
+    parts = []
+    for _, part in long_df.groupby("Показатель", sort=False):
+        part = part.dropna(subset=["Значение"]).sort_values("Дата_Время", kind="stable")
+        x = part["Дата_Время"].values.astype("datetime64[ns]").astype(np.int64).astype(np.float64)
+        y = part["Значение"].values.astype(np.float64)
+        parts.append(part.iloc[lttb_indices(x, y, max_points)])
+    return pd.concat(parts) if parts else long_df
+
+def percent_changes(df_filtered, cube, cells, date_index, metrics, mode):
+    """Процентные изменения только для выбранных показателей.
+
+    mode: "rows" - подряд по строкам, "Время"/"№ смены" - внутри каждой группы,
+    "day"/"week" - между суммами соседних дней или недель ISO.
+    Пропуски, как и раньше, заполняются предыдущим значением ряда.
+    """
+    if mode in ("day", "week"):
+        table = dynamics_frame(df_filtered, cube, cells, date_index, metrics, mode)
+        table = table.pivot(index="Дата_Время", columns="Показатель", values="Значение")[metrics]
+        table = table.rename_axis(index="Период", columns=None).reset_index()
+        changes = table[metrics].pct_change(fill_method=None) * 100
+    else:
+        table = df_filtered[["Дата", "Время", "№ смены"] + metrics]
+        if mode == "rows":
+            changes = table[metrics].ffill().pct_change(fill_method=None) * 100
+        else:
+            groups = table[mode]
+            filled = table[metrics].groupby(groups, observed=True).ffill()
+            changes = filled.groupby(groups, observed=True).pct_change(fill_method=None) * 100
+    
+    changes.columns = [f"Δ {col} (%)" for col in metrics]
+    return pd.concat([table, changes], axis=1)
+
+
+def cube_frame(cube, date_index):
+    """Куб агрегатов таблицей: строка на (Дата, Время, № смены) с суммами и числом записей"""
+    frame = cube["sum"].copy()
+    frame.insert(0, "Дата", date_index["dates"][cube["day"]])
+    frame.insert(1, "Время", pd.Categorical.from_codes(cube["time"], categories=cube["time_categories"]))
+    frame.insert(2, "№ смены", pd.Categorical.from_codes(cube["number"], categories=cube["number_categories"]))
+    frame["Всего записей"] = cube["rows"]
+    return frame
+
+def build_trends(cube, date_index, columns):
+    """Префиксные суммы по календарным дням для каждого номера смены и показателя.
+
+    Строятся один раз на набор данных из куба агрегатов. Сумма показателя и
+    число дней с данными за любое окно дней - разность двух элементов префикса.
+    """
+    dates = date_index["dates"]
+    days = pd.date_range(dates[0], dates[-1], freq="D") if len(dates) else pd.DatetimeIndex([])
+    # Номер календарного дня для каждого дня индекса: дни без данных тоже занимают место
+    offsets = (dates - dates[0]).days.values if len(dates) else np.array([], dtype=np.int64)
+    
+    grouped = cube["sum"][columns].groupby([cube["number"], offsets[cube["day"]]], sort=False).sum()
+    number_codes = grouped.index.get_level_values(0).values
+    day_codes = grouped.index.get_level_values(1).values
+    
+    daily = np.zeros((len(cube["number_categories"]), len(columns), len(days)))
+    daily[number_codes, :, day_codes] = grouped.values.astype(np.float64)
+    present = np.zeros((len(cube["number_categories"]), len(days)))
+    present[number_codes, day_codes] = 1
+    
+    return {
+        "days": days,
+        "offsets": offsets,
+        "columns": list(columns),
+        "number_categories": cube["number_categories"],
+        "sum": np.pad(daily.cumsum(axis=-1), [(0, 0), (0, 0), (1, 0)]),
+        "present": np.pad(present.cumsum(axis=-1), [(0, 0), (1, 0)]),
+    }
+
+def window_means(trends, metric, ends, window):
+    """Среднее за день по окнам из window дней, оканчивающимся в днях ends (включительно).
+
+    Делится на число дней с данными в окне, поэтому пропуски не занижают
+    среднее; окно без данных дает NaN. Результат - массив (номер смены, день).
+    """
+    column = trends["columns"].index(metric)
+    stop = np.clip(ends + 1, 0, None)
+    start = np.clip(ends + 1 - window, 0, None)
+    sums = trends["sum"][:, column, stop] - trends["sum"][:, column, start]
+    days = trends["present"][:, stop] - trends["present"][:, start]
+    return sums / np.where(days > 0, days, np.nan)
+
+def trend_frame(trends, metric, numbers, start, end, windows=(7, 14, 28)):
+    """Тренды показателя по календарным дням [start, end] для кодов номеров смен numbers.
+
+    Столбцы: Дата, № смены, За день, Среднее N дн., Неделя к неделе (%) и
+    Месяц к месяцу (%). Изменения сравнивают средние за последние 7 и 28 дней
+    со средними за предыдущие 7 и 28: в обоих окнах одинаково каждого дня недели.
+    """
+    ends = np.arange(start, end + 1)
+    columns = {"За день": window_means(trends, metric, ends, 1)}
+    for window in windows:
+        columns[f"Среднее {window} дн."] = window_means(trends, metric, ends, window)
+    for name, window in [("Неделя к неделе (%)", 7), ("Месяц к месяцу (%)", 28)]:
+        current = window_means(trends, metric, ends, window)
+        previous = window_means(trends, metric, ends - window, window)
+        columns[name] = (current / np.where(previous != 0, previous, np.nan) - 1) * 100
+    
+    frames = []
+    for code in numbers:
+        frame = pd.DataFrame({name: values[code] for name, values in columns.items()})
+        frame.insert(0, "Дата", trends["days"][ends])
+        frame.insert(1, "№ смены", trends["number_categories"][code])
+        frames.append(frame)
+    return pd.concat(frames, ignore_index=True)
+
+# ==================== КОНВЕЙЕР ======================
+REQUIRED_COLUMNS = ["Дата", "Время", "№ смены"]
+
+def streaming_threshold():
+    """Размер книги в байтах, начиная с которого она читается потоково (DASHBOARD_STREAMING_MB)"""
+    return float(os.environ.get("DASHBOARD_STREAMING_MB", 5)) * 1024 * 1024
+
+def load_and_clean(source, timings=None, streaming=False, progress=None):
+    """Очищенные данные книги: потоково через stream_excel или load_excel_separately и clean_data.
+
+    Без обязательных столбцов выбрасывает MissingColumnsError. progress
+    передается загрузчику, этап очистки сообщается отдельно.
+    """
+    timings = {} if timings is None else timings
+    
+    if streaming:
+        started = time.perf_counter()
+        df = stream_excel(source, timings, progress=progress)
+        timings["Потоковая загрузка"] = time.perf_counter() - started
+    else:
+        started = time.perf_counter()
+        df = load_excel_separately(source, timings, progress=progress)
+        timings["Загрузка файла"] = time.perf_counter() - started
+        
+        missing_columns = [col for col in REQUIRED_COLUMNS if col not in df.columns]
+        if missing_columns:
+            raise MissingColumnsError(missing_columns, list(df.columns))
+        
+        if progress is not None:
+            progress("Очистка данных")
+        started = time.perf_counter()
+        df = clean_data(df, timings)
+        timings["Очистка данных"] = time.perf_counter() - started
+    
+    return df
+
+def process_workbook(source, timings=None, streaming=False):
+    """Загрузка, очистка, индекс дат и куб агрегатов одной книги без Streamlit.
+
+    source - путь или файлоподобный объект; streaming=True читает лист через
+    stream_excel. Возвращает словарь как в кэше дашборда: df, date_index,
+    cube, timings.
+    """
+    timings = {} if timings is None else timings
+    df = load_and_clean(source, timings, streaming)
+    
+    date_index = build_date_index(df)
+    started = time.perf_counter()
+    cube = build_cube(df, date_index)
+    timings["Куб агрегатов"] = time.perf_counter() - started
+    
+    return {"df": df, "date_index": date_index, "cube": cube, "timings": timings}
+
+class ParseCancelled(Exception):
+    """Разбор загрузки отменен"""
+
+class ParseJob:
+    """Разбор загруженной книги в пуле потоков с прогрессом и отменой.
+
+    Книга любого размера читается потоково (stream_excel): прогресс и проверка
+    отмены идут после каждой пачки строк, а не после чтения всего листа.
+    Загрузчики сообщают этап и число разобранных строк через report(); после
+    cancel() следующий вызов report() прерывает разбор исключением
+    ParseCancelled. Исключения наружу не выходят: при сбое result() дает None,
+    а error - словарь с kind ("header", "columns", "cancelled", "failed"),
+    message и подробностями для показа (preview или found).
+    """
+
+    def __init__(self, key, data, executor):
+        self.key = key
+        self.stage = "В очереди"
+        self.rows = 0
+        self.total_rows = None
+        self.timings = {}
+        self.error = None
+        self.started = time.perf_counter()
+        self._cancelled = threading.Event()
+        self._future = executor.submit(self._run, data)
+
+    def _run(self, data):
+        try:
+            return load_and_clean(io.BytesIO(data), self.timings, streaming=True, progress=self.report)
+        except ParseCancelled:
+            self.error = {"kind": "cancelled", "message": "Разбор файла отменен"}
+        except HeaderNotFoundError as e:
+            self.error = {"kind": "header", "message": str(e), "preview": e.preview}
+        except MissingColumnsError as e:
+            self.error = {"kind": "columns", "message": str(e), "found": e.found}
+        except Exception as e:  # любая ошибка разбора показывается в интерфейсе, а не роняет сессию
+            self.error = {"kind": "failed", "message": f"Ошибка при загрузке файла: {e}"}
+        return None
+
+    def report(self, stage, rows=None, total_rows=None):
+        if self._cancelled.is_set():
+            raise ParseCancelled()
+        self.stage = stage
+        if rows is not None:
+            self.rows = rows
+            self.total_rows = total_rows
+
+    def cancel(self):
+        """Отменяет разбор: задача из очереди снимается, идущая прервется на следующем этапе"""
+        self._cancelled.set()
+        if self._future.cancel():
+            self.error = {"kind": "cancelled", "message": "Разбор файла отменен"}
+
+    @property
+    def done(self):
+        return self._future.done()
+
+    @property
+    def fraction(self):
+        """Доля разобранных строк или None, если их общее число неизвестно"""
+        if not self.total_rows:
+            return None
+        return min(self.rows / self.total_rows, 1.0)
+
+    def result(self):
+        """Очищенный DataFrame; None, пока разбор идет или если он завершился ошибкой"""
+        if not self.done or self._future.cancelled():
+            return None
+        return self._future.result()
+
+# ==================== КЭШ И СНИМКИ ======================
+class LRUCache:
+    """LRU-кэш с ограничением по числу записей и суммарному объему в байтах.
+
+    Используется для загрузок (ключ - хэш содержимого файла) и для результатов,
+    зависящих от состояния фильтров. При превышении лимитов вытесняются давно
+    не использованные записи.
+    """
+
+    def __init__(self, max_entries=8, max_bytes=None):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._sizes = {}
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            if key not in self._entries:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self._entries.move_to_end(key)
+            return self._entries[key]
+
+    def put(self, key, value, nbytes=0):
+        with self._lock:
+            self._entries[key] = value
+            self._entries.move_to_end(key)
+            self._sizes[key] = nbytes
+            # Вытесняем самые старые записи, оставляя хотя бы последнюю
+            while len(self._entries) > 1 and (
+                len(self._entries) > self.max_entries
+                or (self.max_bytes is not None and self.total_bytes > self.max_bytes)
+            ):
+                old_key, _ = self._entries.popitem(last=False)
+                del self._sizes[old_key]
+
+    @property
+    def total_bytes(self):
+        return sum(self._sizes.values())
+
+    def stats(self):
+        with self._lock:
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "entries": len(self._entries),
+                "max_entries": self.max_entries,
+                "bytes": self.total_bytes,
+                "max_bytes": self.max_bytes,
+            }
+
+def snapshot_dir():
+    """Каталог снимков очищенных данных или None, если снимки выключены"""
+    path = os.environ.get("DASHBOARD_SNAPSHOT_DIR")
+    if not path or pa is None:
+        return None
+    return path
+
+def write_arrow(df, path):
+    """Пишет DataFrame вместе с типами и индексом в Arrow-файл"""
+    table = pa.Table.from_pandas(df, preserve_index=True)
+    # Пишем во временный файл, чтобы параллельные сессии не прочитали половину файла
+    tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    with pa.OSFile(tmp_path, "wb") as sink:
+        with pa.ipc.new_file(sink, table.schema) as writer:
+            writer.write_table(table)
+    os.replace(tmp_path, path)
+
+def read_arrow(path):
+    """Читает Arrow-файл через memory map"""
+    table = pa.ipc.open_file(pa.memory_map(path, "r")).read_all()
+    return table.to_pandas()
+
+def snapshot_path(file_hash, directory):
+    """Путь к снимку книги с хэшем file_hash, очищенной текущей версией CLEANING_VERSION"""
+    return os.path.join(directory, f"{file_hash}.v{CLEANING_VERSION}.arrow")
+
+def save_snapshot(df, file_hash, directory):
+    """Сохраняет очищенные данные вместе с типами в Arrow-файл по хэшу книги"""
+    os.makedirs(directory, exist_ok=True)
+    write_arrow(df, snapshot_path(file_hash, directory))
+
+def load_snapshot(file_hash, directory):
+    """Загружает снимок по хэшу книги через memory map; None, если снимка нет"""
+    path = snapshot_path(file_hash, directory)
+    if not os.path.exists(path):
+        return None
+    return read_arrow(path)
+
+def precomputed_workbooks(directory):
+    """Книги со снимками из ночного прогона precompute.py: {имя книги: хэш}.
+
+    Список берется из manifest.json в directory; книги с ошибкой и книги,
+    чей снимок удален, пропускаются. Без манифеста - пустой словарь.
+    """
+    path = os.path.join(directory, "manifest.json")
+    try:
+        with open(path, encoding="utf-8") as f:
+            manifest = json.load(f)
+    except (OSError, ValueError):
+        return {}
+    return {
+        entry["file"]: entry["sha256"] for entry in manifest.get("workbooks", [])
+        if entry.get("status") in ("готово", "пропущен")
+        and os.path.exists(snapshot_path(entry["sha256"], directory))
+    }
+
+# ==================== ИСТОРИЯ ======================
+# Строка истории однозначно определяется датой, временем и номером смены
+HISTORY_KEY = ["Дата", "Время", "№ смены"]
+
+# Слияния в одном процессе идут по очереди: манифест и файлы месяцев общие
+_history_lock = threading.Lock()
+
+def history_dir():
+    """Каталог истории по месяцам или None, если история выключена (DASHBOARD_HISTORY_DIR)"""
+    path = os.environ.get("DASHBOARD_HISTORY_DIR")
+    if not path or pa is None:
+        return None
+    return path
+
+def read_history_manifest(directory):
+    """Манифест истории: версия очистки, влитые загрузки и отпечатки месяцев.
+
+    Загрузки, влитые при другой CLEANING_VERSION, не считаются влитыми: при
+    повторной загрузке книга разбирается заново и ее строки заменяют прежние.
+    """
+    path = os.path.join(directory, "manifest.json")
+    if not os.path.exists(path):
+        return {"cleaning": CLEANING_VERSION, "uploads": [], "months": {}}
+    with open(path, encoding="utf-8") as f:
+        manifest = json.load(f)
+    if manifest.get("cleaning") != CLEANING_VERSION:
+        manifest = {"cleaning": CLEANING_VERSION, "uploads": [], "months": manifest["months"]}
+    return manifest
+
+def write_history_manifest(manifest, directory):
+    path = os.path.join(directory, "manifest.json")
+    tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(manifest, f, ensure_ascii=False, indent=2)
+    os.replace(tmp_path, path)
+
+def history_version(directory):
+    """Версия содержимого истории для ключей кэша; None, если история пуста"""
+    months = read_history_manifest(directory)["months"]
+    if not months:
+        return None
+    return hashlib.sha1(json.dumps(months, sort_keys=True).encode()).hexdigest()[:16]
+
+def history_contains(directory, file_hash):
+    """Была ли загрузка с таким хэшем уже влита в историю"""
+    return file_hash in read_history_manifest(directory)["uploads"]
+
+def month_fingerprint(part):
+    """Отпечаток строк месяца; не зависит от разрядности целых после сжатия типов"""
+    values = part.astype({col: "float64" for col in part.select_dtypes(include="number").columns})
+    values = values.astype({col: str for col in ["Время", "№ смены"] if col in values.columns})
+    hashed = pd.util.hash_pandas_object(values, index=False).values
+    return hashlib.sha1(hashed.tobytes() + "|".join(map(str, part.columns)).encode()).hexdigest()
+
+def history_keys(part):
+    """Ключи строк истории строками; пропуск - пустая строка.
+
+    В загрузке пропуск времени - NaN, а после чтения из Arrow - None, поэтому
+    пропуски приводятся к одному значению до сравнения.
+    """
+    keys = part[HISTORY_KEY].astype({"Время": object, "№ смены": object})
+    keys[["Время", "№ смены"]] = keys[["Время", "№ смены"]].fillna("")
+    return pd.MultiIndex.from_frame(keys.astype(str))
+
+def merge_into_history(df, file_hash, directory, timings=None):
+    """Вливает очищенную загрузку в историю и возвращает список измененных месяцев.
+
+    Месяцы, строки которых не изменились с прошлого слияния, пропускаются по
+    отпечатку. В остальных строки загрузки заменяют все хранимые строки с тем
+    же ключом (Дата, Время, № смены), новые ключи добавляются, а строки, ключей
+    которых в загрузке нет, остаются в истории. Повторы ключа внутри одной
+    загрузки сохраняются как есть.
+    """
+    if timings is None:
+        timings = {}
+    started = time.perf_counter()
+    changed = []
+    
+    with _history_lock:
+        os.makedirs(directory, exist_ok=True)
+        manifest = read_history_manifest(directory)
+        months = df["Дата"].dt.strftime("%Y-%m")
+        
+        for month, part in df.groupby(months.values, sort=True):
+            fingerprint = month_fingerprint(part)
+            if manifest["months"].get(month, {}).get("source") == fingerprint:
+                continue
+            
+            # Категории храним строками: у разных загрузок свои наборы значений
+            part = part.astype({"Время": object, "№ смены": object})
+            path = os.path.join(directory, f"{month}.arrow")
+            if os.path.exists(path):
+                stored = read_arrow(path)
+                upload_keys = history_keys(part)
+                stored_keys = history_keys(stored)
+                part = pd.concat([stored[~stored_keys.isin(upload_keys)], part], ignore_index=True)
+            part = part.sort_values("Дата", kind="stable").reset_index(drop=True)
+            write_arrow(part, path)
+            
+            manifest["months"][month] = {"rows": len(part), "source": fingerprint}
+            changed.append(month)
+        
+        manifest["uploads"].append(file_hash)
+        write_history_manifest(manifest, directory)
+    
+    timings["Слияние с историей"] = time.perf_counter() - started
+    return changed
+
+def load_history(directory, timings=None):
+    """Вся история одним DataFrame в том же виде, что дает clean_data"""
+    if timings is None:
+        timings = {}
+    started = time.perf_counter()
+    months = sorted(read_history_manifest(directory)["months"])
+    parts = [read_arrow(os.path.join(directory, f"{month}.arrow")) for month in months]
+    df = pd.concat(parts, ignore_index=True)
+    
+    df.attrs["memory_before"] = int(df.memory_usage(deep=True).sum())
+    df = compact_dtypes(df)
+    timings["Чтение истории"] = time.perf_counter() - started
+    return df
+
+# ==================== ПАПКА НАБЛЮДЕНИЯ ======================
+def watch_dir():
+    """Папка с книгами для фонового разбора или None, если режим выключен (DASHBOARD_WATCH_DIR)"""
+    return os.environ.get("DASHBOARD_WATCH_DIR") or None
+
+def watch_interval():
+    """Период опроса папки в секундах (DASHBOARD_WATCH_INTERVAL)"""
+    return float(os.environ.get("DASHBOARD_WATCH_INTERVAL", 5))
+
+def file_signature(path):
+    """Подпись файла для поиска изменений: время изменения и размер"""
+    stat = os.stat(path)
+    return stat.st_mtime_ns, stat.st_size
+
+def parse_watched_file(path):
+    """Разбор книги из папки в фоновом потоке: тот же конвейер, что у загрузки"""
+    streaming = os.path.getsize(path) >= streaming_threshold()
+    result = process_workbook(path, streaming=streaming)
+    result["profile"] = dataset_profile(result["df"])
+    return result
+
+class FolderWatcher:
+    """Фоновый разбор книг из папки: измененные файлы разбираются в пуле потоков.
+
+    Поток опрашивает папку раз в interval секунд и сравнивает время изменения и
+    размер каждого .xlsx с разобранной версией. Файл уходит в разбор, когда его
+    подпись не менялась между двумя опросами (копирование закончено). Готовый
+    набор заменяет прежний целиком, поэтому сессии видят только полностью
+    разобранные данные; при ошибке разбора остается прошлая версия файла.
+    Пул потоков, а не процессов: Streamlit подменяет __main__ скриптом
+    дашборда, и процесс, запущенный через spawn, выполнил бы его заново.
+    """
+
+    def __init__(self, directory, interval=5.0, workers=1):
+        self.directory = directory
+        self.interval = interval
+        # Растет при каждой публикации или удалении набора
+        self.version = 0
+        self._datasets = {}
+        self._errors = {}
+        self._pending = {}
+        self._seen = {}
+        self._uploaded = {}
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        self._pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="folder-parser")
+        self._thread = threading.Thread(target=self._run, name="folder-watcher", daemon=True)
+
+    def start(self):
+        os.makedirs(self.directory, exist_ok=True)
+        self._thread.start()
+        return self
+
+    def _run(self):
+        while True:
+            try:
+                self.scan()
+            except OSError:  # папка временно недоступна, повторим при следующем опросе
+                pass
+            self._wake.wait(self.interval)
+            self._wake.clear()
+
+    def scan(self):
+        """Один опрос папки: отправляет в разбор измененные файлы, забывает удаленные"""
+        current = {}
+        for entry in os.scandir(self.directory):
+            if entry.is_file() and entry.name.endswith(".xlsx") and not entry.name.startswith(("~$", ".")):
+                stat = entry.stat()
+                current[entry.name] = (stat.st_mtime_ns, stat.st_size)
+        
+        submitted = []
+        with self._lock:
+            for name in set(self._datasets) - set(current):
+                del self._datasets[name]
+                self.version += 1
+            for name in set(self._errors) - set(current):
+                del self._errors[name]
+            
+            for name, signature in current.items():
+                stable = self._seen.get(name) == signature
+                known = (self._datasets.get(name, {}).get("signature"), self._pending.get(name),
+                         self._errors.get(name, {}).get("signature"))
+                if not stable or signature in known:
+                    continue
+                self._pending[name] = signature
+                future = self._pool.submit(parse_watched_file, os.path.join(self.directory, name))
+                submitted.append((name, signature, future))
+            self._seen = current
+        
+        # Обработчики подключаем после снятия блокировки: для уже завершенного
+        # разбора _publish вызывается сразу в этом потоке и сам берет блокировку
+        for name, signature, future in submitted:
+            future.add_done_callback(functools.partial(self._publish, name, signature))
+
+    def _publish(self, name, signature, future):
+        with self._lock:
+            if self._pending.get(name) == signature:
+                del self._pending[name]
+            if self._seen.get(name) != signature:
+                return  # файл изменился во время разбора, новую версию разберет следующий опрос
+            try:
+                result = future.result()
+            except Exception as e:
+                self._errors[name] = {"signature": signature, "message": str(e)}
+            else:
+                result["signature"] = signature
+                result["parsed_at"] = time.time()
+                self._datasets[name] = result
+                self._errors.pop(name, None)
+            self.version += 1
+
+    def add_file(self, name, data):
+        """Кладет загруженную книгу в папку; тот же файл повторно не перезаписывается"""
+        name = os.path.basename(name)
+        digest = hashlib.sha256(data).hexdigest()
+        with self._lock:
+            if self._uploaded.get(name) == digest:
+                return
+        
+        path = os.path.join(self.directory, name)
+        tmp_path = os.path.join(self.directory, f".{name}.{os.getpid()}.tmp")
+        with open(tmp_path, "wb") as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+        
+        with self._lock:
+            self._uploaded[name] = digest
+            # Файл записан целиком, второго опроса для проверки не нужно
+            self._seen[name] = file_signature(path)
+        self._wake.set()
+
+    def datasets(self):
+        """Готовые наборы: имя файла -> словарь process_workbook с profile и signature"""
+        with self._lock:
+            return dict(self._datasets)
+
+    def status(self):
+        """Файлы без готовой текущей версии: имя -> (состояние, сообщение об ошибке)"""
+        with self._lock:
+            states = {}
+            for name, signature in self._seen.items():
+                if name in self._errors and self._errors[name]["signature"] == signature:
+                    states[name] = ("ошибка", self._errors[name]["message"])
+                elif name in self._pending:
+                    states[name] = ("в разборе", None)
+                elif self._datasets.get(name, {}).get("signature") != signature:
+                    states[name] = ("ожидает", None)
+            return states
+
+# ==================== DUCKDB ======================
+def duckdb_path():
+    """Файл DuckDB для SQL-бэкенда или None, если бэкенд выключен (DASHBOARD_DUCKDB)"""
+    path = os.environ.get("DASHBOARD_DUCKDB")
+    if not path or duckdb is None:
+        return None
+    return path
+
+def quote(name):
+    """Имя столбца в кавычках для SQL"""
+    return '"' + str(name).replace('"', '""') + '"'
+
+class DuckDBStore:
+    """Накопленные очищенные данные в файле DuckDB: фильтры и агрегаты запросами.
+
+    Все загрузки вливаются в одну таблицу dataset по ключу строки (Дата, Время,
+    № смены), поэтому файл растет на новые строки, а не на копию каждой книги.
+    В сессии остаются только индекс дат, куб агрегатов и строки, отобранные
+    фильтрами сайдбара. Соединение одно на процесс, каждый запрос идет через
+    свой курсор, записи идут по очереди.
+    """
+
+    table = quote("dataset")
+
+    def __init__(self, path):
+        self.path = path
+        self._con = duckdb.connect(path)
+        self._lock = threading.Lock()
+        self._con.execute("CREATE TABLE IF NOT EXISTS uploads (seq BIGINT, hash VARCHAR, cleaning INTEGER)")
+
+    def contains(self, file_hash):
+        """Была ли загрузка с таким хэшем влита в таблицу текущей версией очистки"""
+        cursor = self._con.cursor()
+        return cursor.execute(
+            "SELECT count(*) FROM uploads WHERE hash = ? AND cleaning = ?", [file_hash, CLEANING_VERSION]
+        ).fetchone()[0] > 0
+
+    def version(self):
+        """Версия накопленной таблицы для ключей кэша; None, пока в нее ничего не влито"""
+        cursor = self._con.cursor()
+        hashes = [row[0] for row in cursor.execute("SELECT hash FROM uploads ORDER BY seq").fetchall()]
+        if not hashes:
+            return None
+        return hashlib.sha1("|".join(hashes).encode()).hexdigest()[:16]
+
+    def upsert(self, df, file_hash):
+        """Вливает очищенную загрузку в накопленную таблицу.
+
+        Строки загрузки заменяют хранимые строки с тем же ключом, новые ключи
+        добавляются, остальные строки остаются. Числа хранятся как DOUBLE:
+        разрядность целых у разных загрузок своя. Номер строки _row сохраняет
+        порядок загрузок внутри дня.
+        """
+        numeric = list(df.select_dtypes(include="number").columns)
+        incoming = df.reset_index(drop=True).astype({"Время": object, "№ смены": object,
+                                                     **{col: "float64" for col in numeric}})
+        # Пропуски категорий пишем как NULL, чтобы ключи сравнивались через IS NOT DISTINCT FROM
+        for col in ["Время", "№ смены"]:
+            incoming[col] = incoming[col].where(incoming[col].notna(), None)
+        
+        with self._lock:
+            cursor = self._con.cursor()
+            cursor.begin()
+            try:
+                found = cursor.execute(
+                    "SELECT count(*) FROM information_schema.tables WHERE table_name = 'dataset'"
+                ).fetchone()[0]
+                if found:
+                    stored = {row[0] for row in cursor.execute(f"DESCRIBE {self.table}").fetchall()}
+                    for col in incoming.columns:
+                        if col not in stored:
+                            kind = "DOUBLE" if col in numeric else "VARCHAR"
+                            cursor.execute(f"ALTER TABLE {self.table} ADD COLUMN {quote(col)} {kind}")
+                    start = cursor.execute(f"SELECT coalesce(max(_row) + 1, 0) FROM {self.table}").fetchone()[0]
+                else:
+                    start = 0
+                incoming.insert(0, "_row", np.arange(start, start + len(incoming), dtype=np.int64))
+                
+                cursor.register("incoming", incoming)
+                if found:
+                    cursor.execute(
+                        f'DELETE FROM {self.table} AS d WHERE EXISTS (SELECT 1 FROM incoming AS i '
+                        f'WHERE i."Дата" = d."Дата" AND i."Время" IS NOT DISTINCT FROM d."Время" '
+                        f'AND i."№ смены" IS NOT DISTINCT FROM d."№ смены")'
+                    )
+                    cursor.execute(f"INSERT INTO {self.table} BY NAME SELECT * FROM incoming")
+                else:
+                    cursor.execute(
+                        f'CREATE TABLE {self.table} AS SELECT * REPLACE (CAST("Время" AS VARCHAR) AS "Время", '
+                        f'CAST("№ смены" AS VARCHAR) AS "№ смены") FROM incoming'
+                    )
+                cursor.execute("INSERT INTO uploads SELECT coalesce(max(seq) + 1, 0), ?, ? FROM uploads",
+                               [file_hash, CLEANING_VERSION])
+                cursor.commit()
+            except Exception:
+                cursor.rollback()
+                raise
+            finally:
+                cursor.unregister("incoming")
+
+    def numeric_columns(self):
+        cursor = self._con.cursor()
+        described = cursor.execute(f"DESCRIBE {self.table}").fetchall()
+        numeric = ("TINYINT", "SMALLINT", "INTEGER", "BIGINT", "FLOAT", "DOUBLE")
+        return [name for name, kind, *_ in described if kind in numeric and name not in ("_row", "№ смены")]
+
+    def date_index(self):
+        """Индекс дат из числа строк по дням, как build_date_index для накопленной таблицы"""
+        cursor = self._con.cursor()
+        counts = cursor.execute(
+            f'SELECT "Дата", count(*) AS n FROM {self.table} GROUP BY "Дата" ORDER BY "Дата"'
+        ).df()
+        ends = counts["n"].cumsum().values.astype(np.int64)
+        return date_index_from_days(pd.DatetimeIndex(counts["Дата"]), ends - counts["n"].values, int(ends[-1]) if len(ends) else 0)
+
+    def build_cube(self, date_index):
+        """Куб агрегатов одним GROUP BY в DuckDB; структура как у build_cube"""
+        columns = self.numeric_columns()
+        aggregates = []
+        for i, col in enumerate(columns):
+            aggregates += [
+                f"coalesce(sum({quote(col)}), 0) AS s{i}",
+                f"count({quote(col)}) AS n{i}",
+                f"coalesce(sum(CAST({quote(col)} AS DOUBLE) ^ 2), 0) AS q{i}",
+            ]
+        cursor = self._con.cursor()
+        cells = cursor.execute(
+            f'SELECT "Дата", "Время", "№ смены", count(*) AS _rows{"".join(", " + a for a in aggregates)} '
+            f'FROM {self.table} GROUP BY ALL'
+        ).df()
+        
+        time_categories = pd.Index(sorted(cells["Время"].dropna().unique()), dtype=object)
+        number_categories = pd.Index(sorted(cells["№ смены"].dropna().unique()), dtype=object)
+        day = date_index["dates"].get_indexer(cells["Дата"])
+        time_codes = time_categories.get_indexer(cells["Время"])
+        number_codes = number_categories.get_indexer(cells["№ смены"])
+        # Порядок ячеек как у groupby(sort=True) в build_cube
+        order = np.lexsort((number_codes, time_codes, day))
+        
+        def part(prefix):
+            frame = cells[[f"{prefix}{i}" for i in range(len(columns))]].iloc[order]
+            frame.columns = columns
+            return frame.reset_index(drop=True)
+        
+        return {
+            "day": day[order],
+            "time": time_codes[order],
+            "number": number_codes[order],
+            "time_categories": time_categories,
+            "number_categories": number_categories,
+            "sum": part("s"),
+            "count": part("n"),
+            "sumsq": part("q"),
+            "rows": cells["_rows"].values[order],
+        }
+
+    def filter_rows(self, date_index, cube, selected_days, selected_shifts, selected_shift_numbers):
+        """Строки под фильтры сайдбара; отбор выполняет DuckDB, в Python приходит только результат"""
+        # Серии выбранных дней превращаются в диапазоны дат, как срезы в filter_rows
+        edges = np.flatnonzero(np.diff(np.r_[0, selected_days.astype(np.int8), 0]))
+        ranges = [(date_index["dates"][first], date_index["dates"][last - 1])
+                  for first, last in zip(edges[::2], edges[1::2])]
+        where = " OR ".join(['"Дата" BETWEEN ? AND ?'] * len(ranges)) or "false"
+        params = [day for period in ranges for day in period]
+        
+        cursor = self._con.cursor()
+        df = cursor.execute(
+            f'SELECT * FROM {self.table} '
+            f'WHERE ({where}) AND list_contains(?, "Время") AND list_contains(?, "№ смены") '
+            f'ORDER BY "Дата", "_row"',
+            params + [[str(s) for s in selected_shifts], [str(n) for n in selected_shift_numbers]],
+        ).df()
+        return self._restore_dtypes(df, cube)
+
+    @staticmethod
+    def _restore_dtypes(df, cube):
+        """Возвращает выборке из таблицы индекс строк и типы, как после clean_data"""
+        df = df.set_index("_row").rename_axis(None)
+        df["Время"] = pd.Categorical(df["Время"], categories=cube["time_categories"])
+        df["№ смены"] = pd.Categorical(df["№ смены"], categories=cube["number_categories"])
+        # Счетчики без дробной части возвращаем в целые, как после compact_dtypes
+        for col in df.select_dtypes(include="number").columns:
+            df[col] = pd.to_numeric(df[col], downcast="integer")
+        return df
+
+    def profile(self, date_index, cube):
+        """Сводка для блока информации о данных, как dataset_profile, без загрузки строк"""
+        table = self.table
+        cursor = self._con.cursor()
+        head = self._restore_dtypes(cursor.execute(f'SELECT * FROM {table} ORDER BY "Дата", "_row" LIMIT 5').df(), cube)
+        
+        non_null = cursor.execute(
+            f"SELECT {', '.join(f'count({quote(col)})' for col in head.columns)} FROM {table}"
+        ).fetchone()
+        
+        def value_counts(col, categories, codes):
+            counts = pd.Series(cube["rows"]).groupby(codes).sum()
+            counts = counts[counts.index >= 0]
+            return pd.Series(counts.values, index=pd.CategoricalIndex(categories[counts.index], categories=categories, name=col),
+                             name="count")
+        
+        rows = int(cube["rows"].sum())
+        return {
+            "rows": rows,
+            "columns": [(col, str(head[col].dtype), count) for col, count in zip(head.columns, non_null)],
+            "memory_mb": None,
+            "memory_before_mb": None,
+            "start": date_index["dates"][0] if rows else None,
+            "end": date_index["dates"][-1] if rows else None,
+            "time_counts": value_counts("Время", cube["time_categories"], cube["time"]).sort_values(ascending=False),
+            "shift_counts": value_counts("№ смены", cube["number_categories"], cube["number"]),
+            "head": head,
+        }
+
+# ==================== ДИАГНОСТИКА ======================
+def diagnostics_enabled():
+    """Включена ли диагностика прогонов переменной окружения DASHBOARD_DIAGNOSTICS"""
+    return os.environ.get("DASHBOARD_DIAGNOSTICS", "").lower() in ("1", "true", "yes", "on")
+
+class StageProfiler:
+    """Время и пик памяти по этапам одного прогона скрипта.
+
+    Этапы идут подряд: mark() закрывает текущий этап и открывает следующий,
+    finish() закрывает последний. Память считает tracemalloc, поэтому пик -
+    это прирост аллокаций Python относительно начала этапа; трассировка
+    общая для процесса, и при параллельных сессиях пики могут смешиваться.
+    Запущенная трассировка не останавливается, поэтому профилировщик
+    включается только при заданной DASHBOARD_DIAGNOSTICS.
+    В выключенном состоянии методы сразу возвращаются.
+    """
+
+    def __init__(self, enabled=False):
+        self.enabled = enabled
+        self.stages = []
+        self._current = None
+        self._started = 0.0
+        self._base = 0
+        if enabled and not tracemalloc.is_tracing():
+            tracemalloc.start()
+
+    def mark(self, name):
+        if not self.enabled:
+            return
+        now = time.perf_counter()
+        self._close(now)
+        self._current = name
+        tracemalloc.reset_peak()
+        self._base = tracemalloc.get_traced_memory()[0]
+        self._started = time.perf_counter()
+
+    def finish(self):
+        if self.enabled:
+            self._close(time.perf_counter())
+            self._current = None
+        return self.stages
+
+    def _close(self, now):
+        if self._current is None:
+            return
+        current, peak = tracemalloc.get_traced_memory()
+        self.stages.append({
+            "Этап": self._current,
+            "Время, с": now - self._started,
+            "Пик памяти, МБ": max(peak - self._base, 0) / 1024 ** 2,
+            "Удержано, МБ": (current - self._base) / 1024 ** 2,
+        })
+
+    @property
+    def total_seconds(self):
+        return sum(stage["Время, с"] for stage in self.stages)
+
+    def write_log(self, path, **context):
+        """Дописывает прогон строкой JSON в журнал path"""
+        record = {"time": datetime.now().isoformat(timespec="seconds"), **context, "stages": self.stages}
+        with open(path, "a", encoding="utf-8") as f:
+            f.write(json.dumps(record, ensure_ascii=False) + "\n")
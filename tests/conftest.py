@@ -0,0 +1,23 @@
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from benchmark import generate_workbook
+from processing import clean_data, load_excel_separately
+
+
+@pytest.fixture(scope="session")
+def workbook(tmp_path_factory):
+    """Книга Грузооборот как у рабочих файлов: объединенные даты, смены в разных алфавитах"""
+    path = tmp_path_factory.mktemp("books") / "gruzooborot.xlsx"
+    generate_workbook(str(path), 600, seed=1)
+    return str(path)
+
+
+@pytest.fixture(scope="session")
+def cleaned(workbook):
+    """Очищенные данные книги; общий для тестов, менять его нельзя"""
+    return clean_data(load_excel_separately(workbook))
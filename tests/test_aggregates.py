@@ -0,0 +1,48 @@
+import numpy as np
+import pytest
+
+from processing import build_cube, build_date_index, cube_cells, filter_rows, shift_summary
+
+
+def random_filters(df, date_index, seed):
+    rng = np.random.default_rng(seed)
+    selected_days = rng.random(len(date_index["dates"])) < 0.4
+    shifts = [v for v in df["Время"].cat.categories if rng.random() < 0.7]
+    numbers = [v for v in df["№ смены"].cat.categories if rng.random() < 0.7]
+    return selected_days, shifts, numbers
+
+
+@pytest.mark.parametrize("seed", range(5))
+def test_cube_totals_match_filtered_rows(cleaned, seed):
+    date_index = build_date_index(cleaned)
+    cube = build_cube(cleaned, date_index)
+    selected_days, shifts, numbers = random_filters(cleaned, date_index, seed)
+    
+    rows = filter_rows(cleaned, date_index, selected_days, shifts, numbers)
+    cells = cube_cells(cube, selected_days, shifts, numbers)
+    columns = list(cube["sum"].columns)
+    
+    assert cube["rows"][cells].sum() == len(rows)
+    np.testing.assert_allclose(cube["sum"].loc[cells, columns].sum().values,
+                               rows[columns].sum().values.astype(float))
+    assert (cube["count"].loc[cells, columns].sum().values == rows[columns].count().values).all()
+    np.testing.assert_allclose(cube["sumsq"].loc[cells, columns].sum().values,
+                               (rows[columns].astype(float) ** 2).sum().values)
+
+
+@pytest.mark.parametrize("seed", range(3))
+def test_shift_summary_matches_groupby(cleaned, seed):
+    date_index = build_date_index(cleaned)
+    cube = build_cube(cleaned, date_index)
+    selected_days, shifts, numbers = random_filters(cleaned, date_index, seed)
+    rows = filter_rows(cleaned, date_index, selected_days, shifts, numbers)
+    columns = ["Разгружено машин", "Принято паллет", "Всего сотрудников", "Грузооборот всего"]
+    
+    summary = shift_summary(cube, cube_cells(cube, selected_days, shifts, numbers), columns)
+    expected = rows.groupby("№ смены", observed=True)[columns].sum()
+    
+    assert summary["№ смены"].astype(str).tolist() == expected.index.astype(str).tolist()
+    np.testing.assert_allclose(summary[columns].values.astype(float), expected.values.astype(float))
+    assert summary["Всего записей"].tolist() == rows.groupby("№ смены", observed=True).size().tolist()
+    efficiency = expected["Грузооборот всего"] / expected["Всего сотрудников"].where(expected["Всего сотрудников"] != 0)
+    np.testing.assert_allclose(summary["Эффективность"].values, efficiency.values)
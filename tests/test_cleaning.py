@@ -0,0 +1,39 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from processing import convert_shift, map_distinct, normalize_time_str
+
+MESSY = [
+    1, 1.0, True, "1", " 1 ", 2, 3.0, "4", 5,
+    None, np.nan, "", " ",
+    "6:00-18:00", "18:00-6:00", "6-18", "18-6", "6.00 – 18.00", "18.00—6.00", " 6:00 - 18:00 ",
+    "А", "A", "а", " Б ", "B", "в", "C", "Г", "d", "x", "смена 2",
+]
+
+INPUTS = {
+    "messy": MESSY,
+    "floats": [1.0, 2.0, 2.5, np.nan, 4.0, 1.0, 6.0, 18.0],
+    "strings": ["6-18", "18-6", "А", " Б ", "", "6.00 – 18.00"] * 3,
+    "empty": [None, np.nan, None],
+}
+
+
+def as_list(series):
+    """Значения для сравнения: любой пропуск - None"""
+    return [None if pd.isna(value) else value for value in series.astype(object)]
+
+
+@pytest.mark.parametrize("func", [normalize_time_str, convert_shift])
+@pytest.mark.parametrize("name", list(INPUTS))
+def test_map_distinct_matches_apply(func, name):
+    series = pd.Series(INPUTS[name], dtype="float64" if name == "floats" else object)
+    expected = as_list(series.apply(func))
+    
+    assert as_list(map_distinct(series, func)) == expected
+    assert as_list(map_distinct(series, func, categorical=True)) == expected
+
+
+def test_map_distinct_keeps_index():
+    series = pd.Series(["6-18", None, "18-6"], index=[10, 5, 7], dtype=object)
+    assert map_distinct(series, normalize_time_str).index.tolist() == [10, 5, 7]
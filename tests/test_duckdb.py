@@ -0,0 +1,84 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+import processing
+from processing import DuckDBStore, build_cube, build_date_index, dataset_profile, filter_rows
+
+from test_aggregates import random_filters
+
+pytest.importorskip("duckdb")
+
+
+@pytest.fixture
+def store(tmp_path, cleaned):
+    store = DuckDBStore(str(tmp_path / "data.duckdb"))
+    store.upsert(cleaned, "upload")
+    return store
+
+
+def test_date_index_and_cube_match_pandas(store, cleaned):
+    date_index = build_date_index(cleaned)
+    cube = build_cube(cleaned, date_index)
+    
+    stored_index = store.date_index()
+    stored_cube = store.build_cube(stored_index)
+    
+    assert (stored_index["dates"] == date_index["dates"]).all()
+    assert (stored_index["ends"] - stored_index["starts"] == date_index["ends"] - date_index["starts"]).all()
+    assert list(stored_cube["sum"].columns) == list(cube["sum"].columns)
+    assert stored_cube["rows"].sum() == cube["rows"].sum() == len(cleaned)
+
+
+@pytest.mark.parametrize("seed", range(3))
+def test_filter_rows_match_pandas(store, cleaned, seed):
+    date_index = build_date_index(cleaned)
+    selected_days, shifts, numbers = random_filters(cleaned, date_index, seed)
+    expected = filter_rows(cleaned, date_index, selected_days, shifts, numbers)
+    
+    stored_index = store.date_index()
+    rows = store.filter_rows(stored_index, store.build_cube(stored_index), selected_days, shifts, numbers)
+    
+    assert rows["Дата"].tolist() == expected["Дата"].tolist()
+    assert rows["Время"].astype(str).tolist() == expected["Время"].astype(str).tolist()
+    assert rows["№ смены"].astype(str).tolist() == expected["№ смены"].astype(str).tolist()
+    columns = list(build_cube(cleaned, date_index)["sum"].columns)
+    np.testing.assert_allclose(rows[columns].values.astype(float), expected[columns].values.astype(float))
+
+
+def test_profile_matches_pandas(store, cleaned):
+    expected = dataset_profile(cleaned)
+    stored_index = store.date_index()
+    profile = store.profile(stored_index, store.build_cube(stored_index))
+    
+    assert profile["rows"] == expected["rows"]
+    assert profile["start"] == expected["start"] and profile["end"] == expected["end"]
+    assert profile["time_counts"].to_dict() == expected["time_counts"].to_dict()
+    assert profile["shift_counts"].to_dict() == expected["shift_counts"].to_dict()
+    assert dict((col, count) for col, _, count in profile["columns"]) == \
+        dict((col, count) for col, _, count in expected["columns"])
+
+
+def test_upsert_replaces_rows_by_key(store, cleaned):
+    version = store.version()
+    changed = cleaned.head(50).copy()
+    changed["Разгружено машин"] = 1000
+    extra = cleaned.head(10).copy()
+    extra["Дата"] = extra["Дата"] + pd.Timedelta(days=3650)
+    
+    store.upsert(pd.concat([changed, extra]), "second")
+    stored_index = store.date_index()
+    rows = store.filter_rows(stored_index, store.build_cube(stored_index),
+                             np.ones(len(stored_index["dates"]), dtype=bool),
+                             list(cleaned["Время"].cat.categories), list(cleaned["№ смены"].cat.categories))
+    
+    assert store.contains("upload") and store.contains("second")
+    assert store.version() != version
+    assert len(rows) == len(cleaned) + len(extra)
+    assert (rows["Разгружено машин"] == 1000).sum() == len(changed)
+
+
+def test_upload_merged_by_older_cleaning_is_not_contained(store, monkeypatch):
+    assert store.contains("upload")
+    monkeypatch.setattr(processing, "CLEANING_VERSION", processing.CLEANING_VERSION + 1)
+    assert not store.contains("upload")
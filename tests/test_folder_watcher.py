@@ -0,0 +1,54 @@
+import threading
+import time
+from concurrent.futures import Future
+
+from processing import FolderWatcher
+
+
+class InlineExecutor:
+    """Пул, у которого задача завершена уже к возврату из submit"""
+
+    def submit(self, func, *args):
+        future = Future()
+        try:
+            future.set_result(func(*args))
+        except Exception as e:
+            future.set_exception(e)
+        return future
+
+
+def run_with_timeout(func, seconds=10):
+    thread = threading.Thread(target=func, daemon=True)
+    thread.start()
+    thread.join(seconds)
+    return not thread.is_alive()
+
+
+def test_scan_publishes_finished_parse_without_deadlock(tmp_path):
+    for i in range(3):
+        (tmp_path / f"broken_{i}.xlsx").write_bytes(b"not a workbook")
+    watcher = FolderWatcher(str(tmp_path), interval=0.1)
+    watcher._pool = InlineExecutor()
+    
+    # Первый опрос запоминает подписи, второй отдает стабильные файлы в разбор
+    assert run_with_timeout(watcher.scan)
+    assert run_with_timeout(watcher.scan)
+    
+    status = watcher.status()
+    assert sorted(status) == ["broken_0.xlsx", "broken_1.xlsx", "broken_2.xlsx"]
+    assert all(state == "ошибка" for state, _ in status.values())
+    assert watcher.datasets() == {}
+
+
+def test_watcher_parses_workbook_and_reports_corrupt_one(tmp_path, workbook):
+    (tmp_path / "broken.xlsx").write_bytes(b"not a workbook")
+    watcher = FolderWatcher(str(tmp_path), interval=0.1).start()
+    with open(workbook, "rb") as f:
+        watcher.add_file("good.xlsx", f.read())
+    
+    deadline = time.time() + 60
+    while time.time() < deadline and ("good.xlsx" not in watcher.datasets() or "broken.xlsx" not in watcher.status()):
+        time.sleep(0.1)
+    
+    assert len(watcher.datasets()["good.xlsx"]["df"]) > 0
+    assert watcher.status()["broken.xlsx"][0] == "ошибка"
@@ -0,0 +1,54 @@
+import numpy as np
+import pandas as pd
+
+import processing
+from processing import history_contains, history_version, load_history, merge_into_history
+
+
+def upload(rows):
+    df = pd.DataFrame(rows, columns=["Дата", "Время", "№ смены", "Грузооборот всего"])
+    df["Дата"] = pd.to_datetime(df["Дата"])
+    df["Время"] = pd.Categorical(df["Время"])
+    df["№ смены"] = pd.Categorical(df["№ смены"])
+    return df
+
+
+ROWS = [
+    ("2024-01-01", "6:00-18:00", "1", 100),
+    ("2024-01-01", None, "2", 200),
+    ("2024-01-02", "18:00-6:00", "3", 300),
+]
+
+
+def test_remerge_of_same_rows_keeps_one_copy_of_missing_time(tmp_path):
+    merge_into_history(upload(ROWS), "first", str(tmp_path))
+    # Правка одной строки меняет отпечаток января, и месяц сливается заново
+    changed = ROWS[:2] + [("2024-01-02", "18:00-6:00", "3", 350)]
+    assert merge_into_history(upload(changed), "second", str(tmp_path)) == ["2024-01"]
+    
+    history = load_history(str(tmp_path))
+    assert len(history) == 3
+    assert history["Время"].isna().sum() == 1
+    assert history["Грузооборот всего"].tolist() == [100, 200, 350]
+
+
+def test_unchanged_upload_keeps_version_and_new_keys_are_appended(tmp_path):
+    merge_into_history(upload(ROWS), "first", str(tmp_path))
+    version = history_version(str(tmp_path))
+    assert merge_into_history(upload(ROWS), "again", str(tmp_path)) == []
+    assert history_version(str(tmp_path)) == version
+    
+    merge_into_history(upload([("2024-02-01", "6:00-18:00", "1", 10)]), "feb", str(tmp_path))
+    history = load_history(str(tmp_path))
+    assert len(history) == 4
+    assert np.array_equal(history["Дата"].dt.month.values, [1, 1, 1, 2])
+
+
+def test_uploads_merged_by_older_cleaning_are_parsed_again(tmp_path, monkeypatch):
+    merge_into_history(upload(ROWS), "first", str(tmp_path))
+    assert history_contains(str(tmp_path), "first")
+    
+    monkeypatch.setattr(processing, "CLEANING_VERSION", processing.CLEANING_VERSION + 1)
+    assert not history_contains(str(tmp_path), "first")
+    # Отпечатки месяцев остаются: история по-прежнему читается
+    assert len(load_history(str(tmp_path))) == 3
@@ -0,0 +1,35 @@
+import openpyxl
+import pandas as pd
+import pytest
+
+from benchmark import EMPLOYEE_COLUMNS, MAIN_COLUMNS
+from processing import clean_data, load_excel_separately, stream_excel
+
+
+def sheet_rows(path):
+    """Строки данных листа как есть: после строки отчета и двух строк заголовков"""
+    wb = openpyxl.load_workbook(path, read_only=True)
+    try:
+        return [list(row) for row in wb["Грузооборот"].iter_rows(min_row=4, values_only=True)]
+    finally:
+        wb.close()
+
+
+def test_employee_columns_stay_on_their_sheet_row(workbook):
+    rows = sheet_rows(workbook)
+    # Первая строка - строка подзаголовков сотрудников, ее отбрасывает clean_data
+    df = load_excel_separately(workbook).iloc[1:]
+    
+    # Последняя строка листа не теряется, и у каждой смены свои сотрудники
+    assert len(df) == len(rows)
+    for i, col in enumerate(EMPLOYEE_COLUMNS):
+        expected = [row[len(MAIN_COLUMNS) + i] for row in rows]
+        assert df[col].tolist() == expected
+    assert df["Грузооборот всего"].tolist()[:5] == [row[MAIN_COLUMNS.index("Грузооборот всего")] for row in rows][:5]
+
+
+@pytest.mark.parametrize("chunk_rows", [37, 10_000])
+def test_stream_excel_matches_grid_loader(workbook, chunk_rows):
+    expected = clean_data(load_excel_separately(workbook))
+    result = stream_excel(workbook, chunk_rows=chunk_rows)
+    pd.testing.assert_frame_equal(result, expected)
@@ -0,0 +1,70 @@
+import json
+import os
+
+import openpyxl
+import pytest
+
+from benchmark import generate_workbook
+import processing
+from precompute import precompute_workbook
+from processing import load_snapshot, precomputed_workbooks
+
+pytest.importorskip("pyarrow")
+
+
+@pytest.fixture
+def workbook_without_turnover(tmp_path):
+    path = tmp_path / "books" / "без_грузооборота.xlsx"
+    path.parent.mkdir()
+    generate_workbook(str(path), 50, seed=2)
+    book = openpyxl.load_workbook(path)
+    for cell in book.active[2]:
+        if cell.value == "Грузооборот всего":
+            cell.value = "Итого"
+    book.save(path)
+    return str(path)
+
+
+def test_workbook_without_shift_table_is_skipped_next_run(tmp_path, workbook_without_turnover):
+    output_dir = str(tmp_path / "out")
+    first = precompute_workbook(workbook_without_turnover, output_dir)
+    assert first["status"] == "готово"
+    assert first["shifts"] is None
+    
+    second = precompute_workbook(workbook_without_turnover, output_dir, previous=first)
+    assert second["status"] == "пропущен"
+    assert second["shifts"] is None
+    
+    assert precompute_workbook(workbook_without_turnover, output_dir, force=True, previous=first)["status"] == "готово"
+
+
+def test_write_error_is_reported_per_workbook(tmp_path, workbook_without_turnover):
+    # Каталог на месте файла таблицы ячеек: to_csv падает, как при ошибке записи
+    output_dir = tmp_path / "out"
+    (output_dir / "без_грузооборота.cells.csv").mkdir(parents=True)
+    
+    entry = precompute_workbook(workbook_without_turnover, str(output_dir))
+    assert entry["status"] == "ошибка"
+    assert "error" in entry
+
+
+def test_dashboard_lists_precomputed_snapshots(tmp_path, workbook_without_turnover):
+    output_dir = str(tmp_path / "out")
+    entry = precompute_workbook(workbook_without_turnover, output_dir)
+    broken = {"file": "битая.xlsx", "sha256": "0" * 64, "status": "ошибка", "error": "ValueError"}
+    with open(os.path.join(output_dir, "manifest.json"), "w", encoding="utf-8") as f:
+        json.dump({"workbooks": [entry, broken]}, f, ensure_ascii=False)
+    
+    precomputed = precomputed_workbooks(output_dir)
+    assert precomputed == {"без_грузооборота.xlsx": entry["sha256"]}
+    assert len(load_snapshot(precomputed["без_грузооборота.xlsx"], output_dir)) == entry["rows"]
+    assert precomputed_workbooks(str(tmp_path)) == {}
+
+
+def test_results_of_older_cleaning_are_recomputed(tmp_path, workbook_without_turnover, monkeypatch):
+    output_dir = str(tmp_path / "out")
+    first = precompute_workbook(workbook_without_turnover, output_dir)
+    
+    monkeypatch.setattr(processing, "CLEANING_VERSION", processing.CLEANING_VERSION + 1)
+    assert load_snapshot(first["sha256"], output_dir) is None
+    assert precompute_workbook(workbook_without_turnover, output_dir, previous=first)["status"] == "готово"
@@ -0,0 +1,42 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from processing import build_cube, build_date_index, build_trends, trend_frame
+
+
+def rolling_reference(cleaned, metric, window):
+    """Средние по окну из window календарных дней через pandas rolling для каждого номера смены"""
+    daily = cleaned.groupby(["№ смены", cleaned["Дата"].dt.normalize()], observed=True)[metric].sum()
+    days = pd.date_range(cleaned["Дата"].min().normalize(), cleaned["Дата"].max().normalize(), freq="D")
+    means = {}
+    for number, series in daily.groupby(level=0, observed=True):
+        # Дни без данных пропускаются в среднем, как в window_means
+        series = series.droplevel(0).reindex(days)
+        means[number] = series.rolling(f"{window}D", min_periods=1).mean()
+    return means
+
+
+@pytest.mark.parametrize("metric", ["Грузооборот всего", "Разгружено машин"])
+def test_trend_frame_matches_pandas_rolling(cleaned, metric):
+    date_index = build_date_index(cleaned)
+    cube = build_cube(cleaned, date_index)
+    trends = build_trends(cube, date_index, [metric])
+    numbers = [code for code, number in enumerate(trends["number_categories"])
+               if (cleaned["№ смены"] == number).any()]
+    frame = trend_frame(trends, metric, numbers, 0, len(trends["days"]) - 1)
+    
+    for window in [1, 7, 28]:
+        reference = rolling_reference(cleaned, metric, window)
+        for code in numbers:
+            number = trends["number_categories"][code]
+            rows = frame[frame["№ смены"] == number]
+            assert (rows["Дата"].values == reference[number].index.values).all()
+            column = "За день" if window == 1 else f"Среднее {window} дн."
+            np.testing.assert_allclose(rows[column].values, reference[number].values)
+            
+            if window > 1:
+                change = {7: "Неделя к неделе (%)", 28: "Месяц к месяцу (%)"}[window]
+                previous = reference[number].shift(window)
+                expected = (reference[number] / previous.where(previous != 0) - 1) * 100
+                np.testing.assert_allclose(rows[change].values, expected.values)